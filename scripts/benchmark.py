@@ -0,0 +1,256 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from synthetic_wiki import create_synthetic_tables, write_synthetic_wiki
+import write_ttl
+from write_ttl import create_EC_dict, create_AO_dict, create_ke_dicts, create_ttl_dicts, hash_tables, import_tables, \
+    partition_tables, select_aop, summarize_metrics
+
+######### Benchmarks for write_ttl.py on a synthetic AOP Wiki
+
+
+def time_selection(AOP_nums, AOP_EC_table, AOP_KE_table, AOP_KER_table):
+    """
+    Time selecting each AOP's rows from the tables
+    :param AOP_nums (list): AOPs to select
+    :param AOP_EC_table: EC table, either full or partitioned by AOP
+    :param AOP_KE_table: KE table, either full or partitioned by AOP
+    :param AOP_KER_table: KER table, either full or partitioned by AOP
+    :return(float): wall time in seconds
+    """
+    start = time.perf_counter()
+    for AOP_num in AOP_nums:
+        select_aop(AOP_num, AOP_EC_table)
+        select_aop(AOP_num, AOP_KE_table)
+        select_aop(AOP_num, AOP_KER_table)
+    return time.perf_counter() - start
+
+
+def time_builders(AOP_nums, AOP_EC_table, AOP_KE_table, AOP_KER_table):
+    """
+    Time the per-AOP table builders
+    :param AOP_nums (list): AOPs to build
+    :param AOP_EC_table: EC table, either full or partitioned by AOP
+    :param AOP_KE_table: KE table, either full or partitioned by AOP
+    :param AOP_KER_table: KER table, either full or partitioned by AOP
+    :return(float): wall time in seconds
+    """
+    start = time.perf_counter()
+    for AOP_num in AOP_nums:
+        create_EC_dict(AOP_num, AOP_EC_table)
+        create_AO_dict(AOP_num, AOP_KE_table)
+        create_ke_dicts(AOP_num, AOP_KER_table)
+    return time.perf_counter() - start
+
+
+def benchmark_partitions(n_aops):
+    """
+    Compare filtering the full tables for every AOP with grouping the tables by AOP once
+    :param n_aops (int): Number of AOPs in the synthetic wiki
+    :return(dict): wall times in seconds of row selection and of the builders, for the
+        full-table scans ("scan") and the partitioned tables ("partitioned"). Partitioned
+        times include grouping the tables.
+    """
+    AOP_EC_table, AOP_KE_table, AOP_KER_table, AOP_info = create_synthetic_tables(n_aops)
+    AOP_nums = list(set(AOP_EC_table["AOP"]))
+    timings = {}
+
+    timings[("scan", "select")] = time_selection(AOP_nums, AOP_EC_table, AOP_KE_table, AOP_KER_table)
+    timings[("scan", "build")] = time_builders(AOP_nums, AOP_EC_table, AOP_KE_table, AOP_KER_table)
+
+    start = time.perf_counter()
+    AOP_EC_parts, AOP_KE_parts, AOP_KER_parts = partition_tables(AOP_EC_table, AOP_KE_table, AOP_KER_table)
+    partition_time = time.perf_counter() - start
+    timings[("partitioned", "select")] = partition_time + time_selection(AOP_nums, AOP_EC_parts, AOP_KE_parts,
+                                                                         AOP_KER_parts)
+    timings[("partitioned", "build")] = partition_time + time_builders(AOP_nums, AOP_EC_parts, AOP_KE_parts,
+                                                                       AOP_KER_parts)
+    return timings
+
+
+def clear_statement_caches():
+    """
+    Empties the term registry, the term feature flags and the relationship predicate and term IRI caches, so a
+        benchmark run does not reuse work done by an earlier run
+    """
+    write_ttl.term_registry.clear()
+    write_ttl.term_features.clear()
+    write_ttl.relationship_predicates.cache_clear()
+    write_ttl.quote_term.cache_clear()
+
+
+def build_statements(AOPs, mode):
+    """
+    Builds the class and individual statement dicts of every AOP, starting from empty caches
+    :param AOPs (list of tuples): (AOP_EC_filtered, KE_order_dict) of each AOP
+    :param mode (str): "per-AOP" to render new, uninterned statements for every term of every AOP as
+        process_term() did before the term registry, or "shared" to use the term registry
+    :return(list): the classes and individuals dicts of each AOP
+    """
+    clear_statement_caches()
+    process_term = write_ttl.process_term
+    if mode == "per-AOP":
+        write_ttl.process_term = write_ttl.format_term
+    try:
+        return [create_ttl_dicts(AOP_EC_filtered, KE_order_dict)[:2] for AOP_EC_filtered, KE_order_dict in AOPs]
+    finally:
+        write_ttl.process_term = process_term
+
+
+def benchmark_term_registry(n_aops, repeat=3):
+    """
+    Compare building the statement dicts of every AOP with and without sharing term statements
+        between AOPs. The dicts of all AOPs are kept, as in a process that serves every AOP.
+        Without sharing, every AOP renders its own copy of the statements of its terms. Every run
+        starts from empty caches, and the order of the modes alternates between repeats.
+    :param n_aops (int): Number of AOPs in the synthetic wiki
+    :param repeat (int): Number of timed runs of each mode
+    :return(dict): fastest wall time in seconds and memory held by the dicts in bytes, by mode ("per-AOP", "shared")
+    """
+    AOP_EC_table, AOP_KE_table, AOP_KER_table, AOP_info = create_synthetic_tables(n_aops)
+    AOP_EC_parts, AOP_KE_parts, AOP_KER_parts = partition_tables(AOP_EC_table, AOP_KE_table, AOP_KER_table)
+    AOPs = [(create_EC_dict(AOP_num, AOP_EC_parts)[1], create_ke_dicts(AOP_num, AOP_KER_parts)[1])
+            for AOP_num in sorted(set(AOP_EC_table["AOP"]))]
+    modes = ["per-AOP", "shared"]
+    times = {mode: [] for mode in modes}
+    for i in range(repeat):
+        for mode in modes if i % 2 == 0 else modes[::-1]:
+            start = time.perf_counter()
+            build_statements(AOPs, mode)
+            times[mode].append(time.perf_counter() - start)
+
+    results = {}
+    for mode in modes:
+        # memory is measured in a separate run, as tracing slows the build down
+        tracemalloc.start()
+        statements = build_statements(AOPs, mode)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del statements
+        results[mode] = (min(times[mode]), memory)
+    clear_statement_caches()
+    return results
+
+
+REAL_WIKI_AOPS = 450  # approximate number of AOPs in the AOP Wiki, the unit of the benchmark scales
+
+
+def run_write_ttl(work_dir, tables_dir, args=()):
+    """
+    Runs write_ttl.py end to end in a separate process
+    :param work_dir (str): Directory to run in, the ttl files are written to work_dir/output/bench
+    :param tables_dir (str): Directory containing the AOP Wiki tables
+    :param args (list): Extra command line arguments for write_ttl.py
+    :return(float, int): wall time in seconds and peak resident memory of the process in bytes
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "write_ttl.py")
+    command = [sys.executable, script, "--tables-dir", tables_dir, "--datestamp", "bench", *args]
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=work_dir, stdout=subprocess.DEVNULL)
+    # wait4 reports the resource usage of this process only, not of every child run so far
+    status, usage = os.wait4(process.pid, 0)[1:]
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_memory = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    return elapsed, peak_memory
+
+
+def benchmark_pipeline(n_aops, branching=1, term_reuse=2, workers=1, seed=0):
+    """
+    Time each stage of write_ttl.py and the whole run on a synthetic wiki written to a temporary directory
+    :param n_aops (int): Number of AOPs in the synthetic wiki
+    :param branching (int): Branching factor of the KER graphs, see create_synthetic_tables()
+    :param term_reuse (float): Term reuse of the synthetic wiki, see create_synthetic_tables()
+    :param workers (int): Number of worker processes used by write_ttl.py
+    :param seed (int): Random seed
+    :return(dict, DF, float, int): wall time in seconds of reading, hashing and partitioning the tables,
+        summary of the per-AOP stages (see summarize_metrics()), end-to-end wall time in seconds and
+        peak resident memory of the end-to-end run in bytes
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        tables_dir = f"{work_dir}/aop_wiki_tables"
+        write_synthetic_wiki(tables_dir, n_aops, branching=branching, term_reuse=term_reuse, seed=seed)
+
+        load_timings = {}
+        start = time.perf_counter()
+        tables = import_tables(tables_dir, use_cache=False)
+        load_timings["import_tables"] = time.perf_counter() - start
+        start = time.perf_counter()
+        hash_tables(*tables)
+        load_timings["hash_tables"] = time.perf_counter() - start
+        start = time.perf_counter()
+        partition_tables(*tables[:3])
+        load_timings["partition_tables"] = time.perf_counter() - start
+        del tables
+
+        metrics_file = f"{work_dir}/metrics.jsonl"
+        elapsed, peak_memory = run_write_ttl(work_dir, tables_dir, ["--no-cache", "--workers", str(workers),
+                                                                   "--metrics", metrics_file])
+        with open(metrics_file) as f:
+            records = [json.loads(line) for line in f]
+    return load_timings, summarize_metrics(records), elapsed, peak_memory
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark write_ttl.py on a synthetic AOP Wiki")
+    parser.add_argument("--scales", type=float, nargs="+", default=[10, 100, 1000],
+                        help=f"Synthetic wiki sizes as multiples of the AOP Wiki ({REAL_WIKI_AOPS} AOPs) to run "
+                             "the pipeline benchmark at (default: 10 100 1000)")
+    parser.add_argument("--branching", type=int, default=1,
+                        help="Maximum number of adjacent KEs that follow each KE (default: 1, chains)")
+    parser.add_argument("--term-reuse", type=float, default=2,
+                        help="Average number of KEs each term is drawn into (default: 2)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes used by write_ttl.py (default: 1)")
+    parser.add_argument("--compare", action="store_true",
+                        help="Instead of the pipeline benchmark, compare full-table scans with partitioned "
+                             "tables and per-AOP with shared term statements")
+    parser.add_argument("--aops", type=int, nargs="+", default=[250, 500, 1000, 2000],
+                        help="Synthetic wiki sizes (number of AOPs) for --compare")
+    args = parser.parse_args()
+
+    if not args.compare:
+        print(f"{'scale':>6} {'AOPs':>8} {'stage':>17} {'total (s)':>10} {'mean (ms)':>10} {'share':>6}")
+        results = []
+        for scale in args.scales:
+            n_aops = max(1, int(scale * REAL_WIKI_AOPS))
+            load_timings, summary, elapsed, peak_memory = benchmark_pipeline(n_aops, args.branching,
+                                                                             args.term_reuse, args.workers)
+            results.append((scale, n_aops, elapsed, peak_memory))
+            for stage, stage_time in load_timings.items():
+                print(f"{scale:>5g}x {n_aops:>8} {stage:>17} {stage_time:>10.3f} {'':>10} {'':>6}")
+            for stage, row in summary.iterrows():
+                print(f"{scale:>5g}x {n_aops:>8} {stage:>17} {row['total (s)']:>10.3f} {row['mean (ms)']:>10.3f} "
+                      f"{row['share']:>6}")
+
+        print("\nEnd-to-end runs of write_ttl.py")
+        print(f"{'scale':>6} {'AOPs':>8} {'time (s)':>9} {'AOPs/s':>8} {'peak memory (MB)':>17}")
+        for scale, n_aops, elapsed, peak_memory in results:
+            print(f"{scale:>5g}x {n_aops:>8} {elapsed:>9.2f} {n_aops / elapsed:>8.0f} {peak_memory / 1e6:>17.1f}")
+        sys.exit()
+
+    print("Selecting AOP rows: full-table scans vs tables partitioned by AOP")
+
+    print(f"{'AOPs':>8} {'stage':>8} {'full scan (s)':>14} {'partitioned (s)':>16} {'speedup':>8}")
+    for n_aops in args.aops:
+        timings = benchmark_partitions(n_aops)
+        for stage in ["select", "build"]:
+            scan_time = timings[("scan", stage)]
+            partition_time = timings[("partitioned", stage)]
+            print(f"{n_aops:>8} {stage:>8} {scan_time:>14.3f} {partition_time:>16.3f} "
+                  f"{scan_time / partition_time:>7.1f}x")
+
+    print("\nClass/individual statements: rendered per AOP vs shared term registry")
+    print(f"{'AOPs':>8} {'mode':>8} {'time (s)':>9} {'memory (MB)':>12}")
+    for n_aops in args.aops:
+        for mode, (elapsed, memory) in benchmark_term_registry(n_aops).items():
+            print(f"{n_aops:>8} {mode:>8} {elapsed:>9.3f} {memory / 1e6:>12.1f}")
@@ -0,0 +1,146 @@
+import argparse
+import sqlite3
+
+######### Index of the relationship edges of every AOP, written by write_ttl.py to output/<datestamp>/edges.sqlite
+
+EDGE_COLUMNS = ["aop", "subject", "predicate", "object", "ke1", "ke2"]
+
+edge_schema = """
+CREATE TABLE IF NOT EXISTS edges (
+    aop INTEGER NOT NULL,
+    subject TEXT NOT NULL,
+    predicate TEXT NOT NULL,
+    object TEXT NOT NULL,
+    ke1 INTEGER,
+    ke2 INTEGER
+);
+CREATE INDEX IF NOT EXISTS edges_aop ON edges (aop);
+CREATE INDEX IF NOT EXISTS edges_subject ON edges (subject);
+CREATE INDEX IF NOT EXISTS edges_predicate ON edges (predicate);
+CREATE INDEX IF NOT EXISTS edges_object ON edges (object);
+CREATE INDEX IF NOT EXISTS edges_ke1 ON edges (ke1);
+CREATE INDEX IF NOT EXISTS edges_ke2 ON edges (ke2);
+"""
+
+
+def open_edge_index(path):
+    """
+    Opens an edge index, creating its table and indexes if they do not exist
+    :param path (str): SQLite database file
+    :return(Connection): connection to the index
+    """
+    connection = sqlite3.connect(path)
+    connection.executescript(edge_schema)
+    return connection
+
+
+def term_pair_edges(AOP_num, term_pairs):
+    """
+    Turns the term pairs of an AOP into edges, one for each suggested relationship of each pair
+        of term IDs
+    :param AOP_num (int): AOP number
+    :param term_pairs (list): TermPair records from create_ttl_dicts()
+    :return(list of tuples): (aop, subject, predicate, object, ke1, ke2) of each distinct edge
+    """
+    edges = {}
+    for pair in term_pairs:
+        if not isinstance(pair.id1, str) or not isinstance(pair.id2, str):
+            continue
+        for relationship_id in pair.relationship_ids:
+            if relationship_id != "":
+                edges[(AOP_num, pair.id1, relationship_id, pair.id2, int(pair.ke1), int(pair.ke2))] = None
+    return list(edges)
+
+
+def replace_aop_edges(connection, AOP_num, term_pairs):
+    """
+    Replaces the edges of an AOP in the index
+    :param connection (Connection): Connection to the index, see open_edge_index()
+    :param AOP_num (int): AOP number
+    :param term_pairs (list): TermPair records from create_ttl_dicts()
+    """
+    connection.execute("DELETE FROM edges WHERE aop = ?", (AOP_num, ))
+    connection.executemany("INSERT INTO edges VALUES (?, ?, ?, ?, ?, ?)", term_pair_edges(AOP_num, term_pairs))
+
+
+def keep_aops(connection, AOP_nums):
+    """
+    Removes the edges of every AOP not in AOP_nums, e.g. AOPs removed from the wiki since the
+        index was copied from a previous run
+    :param connection (Connection): Connection to the index, see open_edge_index()
+    :param AOP_nums (iterable): AOPs to keep
+    """
+    keep = set(AOP_nums)
+    indexed = [row[0] for row in connection.execute("SELECT DISTINCT aop FROM edges")]
+    connection.executemany("DELETE FROM edges WHERE aop = ?", [(AOP_num, ) for AOP_num in indexed
+                                                                if AOP_num not in keep])
+
+
+def source_range(column, source):
+    """
+    Returns an SQL condition matching the IDs of an ontology source (e.g. "GO" for "GO:0004882")
+        as a range, so the column's index can be used
+    :param column (str): "subject" or "object"
+    :param source (str): Ontology source
+    :return(str, list): condition and its parameters
+    """
+    # ";" is the character after ":", so the range holds every ID starting with "<source>:"
+    return f"({column} >= ? AND {column} < ?)", [f"{source}:", f"{source};"]
+
+
+def query_edges(connection, aop=None, subject=None, predicate=None, object=None, touching=None,
+                subject_source=None, object_source=None):
+    """
+    Returns the edges matching every given filter
+    :param connection (Connection): Connection to the index, see open_edge_index()
+    :param aop (int): AOP number
+    :param subject (str): Subject term ID, e.g. "PR:000004191"
+    :param predicate (str): Relationship ID, e.g. "RO_0002212"
+    :param object (str): Object term ID
+    :param touching (str): Term ID that is either the subject or the object
+    :param subject_source (str): Ontology source of the subject, e.g. "GO"
+    :param object_source (str): Ontology source of the object, e.g. "MP"
+    :return(list of tuples): (aop, subject, predicate, object, ke1, ke2) of each matching edge, sorted
+    """
+    conditions = []
+    parameters = []
+    for column, value in [("aop", aop), ("subject", subject), ("predicate", predicate), ("object", object)]:
+        if value is not None:
+            conditions.append(f"{column} = ?")
+            parameters.append(value)
+    if touching is not None:
+        conditions.append("(subject = ? OR object = ?)")
+        parameters += [touching, touching]
+    for column, source in [("subject", subject_source), ("object", object_source)]:
+        if source is not None:
+            condition, condition_parameters = source_range(column, source)
+            conditions.append(condition)
+            parameters += condition_parameters
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    return connection.execute(f"SELECT {', '.join(EDGE_COLUMNS)} FROM edges{where} ORDER BY {', '.join(EDGE_COLUMNS)}",
+                              parameters).fetchall()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the edge index written by write_ttl.py")
+    parser.add_argument("index", help="Edge index, e.g. output/082423/edges.sqlite")
+    parser.add_argument("--aop", type=int, help="AOP number")
+    parser.add_argument("--subject", help="Subject term ID, e.g. PR:000004191")
+    parser.add_argument("--predicate", help="Relationship ID, e.g. RO_0002212")
+    parser.add_argument("--object", help="Object term ID")
+    parser.add_argument("--touching", metavar="ID", help="Term ID that is either the subject or the object")
+    parser.add_argument("--subject-source", help="Ontology source of the subject, e.g. GO")
+    parser.add_argument("--object-source", help="Ontology source of the object, e.g. MP")
+    parser.add_argument("--aops", action="store_true", help="Only print the AOPs that have matching edges")
+    args = parser.parse_args()
+
+    connection = sqlite3.connect(f"file:{args.index}?mode=ro", uri=True)
+    edges = query_edges(connection, args.aop, args.subject, args.predicate, args.object, args.touching,
+                        args.subject_source, args.object_source)
+    if args.aops:
+        for AOP_num in sorted({edge[0] for edge in edges}):
+            print(AOP_num)
+    else:
+        print("\t".join(EDGE_COLUMNS))
+        for edge in edges:
+            print("\t".join(str(value) for value in edge))
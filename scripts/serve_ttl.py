@@ -0,0 +1,261 @@
+import argparse
+import asyncio
+import collections
+import hashlib
+import regex as re
+
+from write_ttl import AOPTables, TABLE_CACHE_DIR, build_aop, clear_term_caches, hash_tables, import_tables, \
+    partition_tables
+
+######### HTTP service that renders AOP ttl files on demand
+
+aop_path = re.compile(r"^/aop/(?:AOP_)?(\d+)\.ttl$")
+reasons = {200: "OK", 304: "Not Modified", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class TTLCache:
+    """
+    LRU cache of rendered ttl documents, bounded by the total size of the documents it holds
+    """
+
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes (int): Maximum total size of the cached documents in bytes
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()  # AOP_num -> (ttl bytes, ETag)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, AOP_num):
+        """
+        :param AOP_num (int): AOP number
+        :return(bytes, str): the cached document and its ETag, or None if the AOP is not cached
+        """
+        entry = self.entries.get(AOP_num)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(AOP_num)
+        return entry
+
+    def put(self, AOP_num, ttl, etag):
+        """
+        Adds a document, evicting the least recently used documents until the cache fits in max_bytes.
+            Documents larger than max_bytes are not cached.
+        :param AOP_num (int): AOP number
+        :param ttl (bytes): Rendered document
+        :param etag (str): ETag of the document
+        """
+        self.invalidate(AOP_num)
+        if len(ttl) > self.max_bytes:
+            return
+        self.entries[AOP_num] = (ttl, etag)
+        self.size += len(ttl)
+        while self.size > self.max_bytes:
+            self.size -= len(self.entries.popitem(last=False)[1][0])
+
+    def invalidate(self, AOP_num):
+        """
+        Removes an AOP from the cache
+        :param AOP_num (int): AOP number
+        """
+        entry = self.entries.pop(AOP_num, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+
+class TTLService:
+    """
+    Holds the AOP Wiki tables in memory and renders AOP ttl documents on demand
+    """
+
+    def __init__(self, tables_dir, cache_bytes, use_cache=True, cache_dir=None):
+        """
+        :param tables_dir (str): Directory containing the AOP Wiki tables
+        :param cache_bytes (int): Maximum total size of the cached documents in bytes
+        :param use_cache (bool): Whether to use the Parquet snapshot of the tables, see import_tables()
+        :param cache_dir (str): Directory holding the snapshots, see import_tables()
+        """
+        self.tables_dir = tables_dir
+        self.use_cache = use_cache
+        self.cache_dir = cache_dir
+        self.cache = TTLCache(cache_bytes)
+        self.tables = None
+        self.hashes = {}
+        self.rendering = {}  # (AOP_num, id of the tables) -> future of a render in progress
+        self.reload_lock = asyncio.Lock()
+        self.swap(*self.load())
+
+    def load(self):
+        """
+        Imports and partitions the tables from tables_dir without changing the service, so it can
+            run on an executor thread
+        :return(AOPTables, dict): the partitioned tables and the input hash of each AOP, see hash_tables()
+        """
+        AOP_EC_table, AOP_KE_table, AOP_KER_table, AOP_info = import_tables(self.tables_dir, self.use_cache,
+                                                                            self.cache_dir)
+        hashes = hash_tables(AOP_EC_table, AOP_KE_table, AOP_KER_table, AOP_info)
+        return AOPTables(*partition_tables(AOP_EC_table, AOP_KE_table, AOP_KER_table), AOP_info), hashes
+
+    def swap(self, tables, hashes):
+        """
+        Replaces the tables and removes the cached documents of the AOPs whose input rows changed or
+            that are no longer in the tables. The term caches are cleared too, so they only hold the
+            terms rendered since the last reload. Must run on the event loop thread, which owns the cache.
+        :param tables (AOPTables): Tables from load()
+        :param hashes (dict): Input hash of each AOP from load()
+        :return(list): AOPs whose cached documents were removed
+        """
+        changed = [AOP_num for AOP_num in list(self.cache.entries) if hashes.get(AOP_num) != self.hashes.get(AOP_num)]
+        for AOP_num in changed:
+            self.cache.invalidate(AOP_num)
+        clear_term_caches()
+        self.tables = tables
+        self.hashes = hashes
+        return changed
+
+    async def reload(self):
+        """
+        Reloads the tables from tables_dir on an executor thread and swaps them in on the event loop.
+            Concurrent reloads run one at a time.
+        :return(list): AOPs whose cached documents were removed
+        """
+        async with self.reload_lock:
+            tables, hashes = await asyncio.get_running_loop().run_in_executor(None, self.load)
+            return self.swap(tables, hashes)
+
+    def render(self, AOP_num, tables):
+        """
+        Renders an AOP's ttl document
+        :param AOP_num (int): AOP number
+        :param tables (AOPTables): Tables to render the AOP from
+        :return(bytes, str): the document and its ETag
+        """
+        ttl = build_aop(AOP_num, tables).ttl.encode()
+        return ttl, f'"{hashlib.sha1(ttl).hexdigest()}"'
+
+    async def get(self, AOP_num):
+        """
+        Returns an AOP's ttl document from the cache, rendering it if it is not cached. Concurrent
+            requests for the same AOP share one render, as long as it renders from the current tables.
+        :param AOP_num (int): AOP number
+        :return(bytes, str): the document and its ETag
+        """
+        entry = self.cache.get(AOP_num)
+        if entry is not None:
+            return entry
+        tables = self.tables
+        # the render holds on to its tables, so their id is not reused while the render is in progress
+        key = (AOP_num, id(tables))
+        future = self.rendering.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(None, self.render, AOP_num, tables)
+            self.rendering[key] = future
+            try:
+                entry = await future
+            finally:
+                del self.rendering[key]
+            # a reload during the render may have changed the AOP, so only cache documents of the current tables
+            if self.tables is tables:
+                self.cache.put(AOP_num, *entry)
+            return entry
+        return await future
+
+    async def handle(self, reader, writer):
+        """
+        Handles one HTTP request:
+            GET /aop/<n>.ttl  returns the ttl document of AOP n (supports If-None-Match)
+            POST /reload      reloads the tables and invalidates the changed AOPs
+        """
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1")
+                if line in ("\r\n", "\n", ""):
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            if len(request_line) < 2:
+                return
+            method, path = request_line[0], request_line[1].split("?")[0]
+
+            match = aop_path.match(path)
+            if path == "/reload":
+                if method != "POST":
+                    await respond(writer, 405, b"Use POST to reload the tables\n")
+                    return
+                changed = await self.reload()
+                await respond(writer, 200, f"Reloaded tables, invalidated {len(changed)} AOP(s)\n".encode())
+            elif match is not None:
+                if method not in ("GET", "HEAD"):
+                    await respond(writer, 405, b"Use GET to fetch AOPs\n")
+                    return
+                AOP_num = int(match.group(1))
+                if AOP_num not in self.tables.EC:
+                    await respond(writer, 404, f"AOP {AOP_num} is not in the tables\n".encode())
+                    return
+                ttl, etag = await self.get(AOP_num)
+                if headers.get("if-none-match") == etag:
+                    await respond(writer, 304, b"", {"ETag": etag})
+                else:
+                    await respond(writer, 200, ttl, {"ETag": etag, "Content-Type": "text/turtle; charset=utf-8"},
+                                  head=method == "HEAD")
+            else:
+                await respond(writer, 404, b"Not found\n")
+        except Exception as e:
+            await respond(writer, 500, f"{type(e).__name__}: {e}\n".encode())
+        finally:
+            writer.close()
+
+
+async def respond(writer, status, body, headers=None, head=False):
+    """
+    Writes an HTTP response
+    :param writer (StreamWriter): Connection to write to
+    :param status (int): HTTP status code
+    :param body (bytes): Response body
+    :param headers (dict): Extra response headers
+    :param head (bool): Whether to leave out the body (HEAD requests)
+    """
+    headers = {"Content-Type": "text/plain; charset=utf-8", **(headers or {}),
+               "Content-Length": str(len(body)), "Connection": "close"}
+    lines = [f"HTTP/1.1 {status} {reasons[status]}"] + [f"{name}: {value}" for name, value in headers.items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+    if not head and status != 304:
+        writer.write(body)
+    await writer.drain()
+
+
+async def serve(service, host, port):
+    """
+    Serves ttl documents until cancelled
+    :param service (TTLService): Service to handle the requests with
+    :param host (str): Host to listen on
+    :param port (int): Port to listen on
+    """
+    server = await asyncio.start_server(service.handle, host, port)
+    print(f"Serving AOP ttl files on http://{host}:{port}/aop/<n>.ttl")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve AOP ttl files rendered on demand from local AOP Wiki tables")
+    parser.add_argument("--tables-dir", default="aop_wiki_tables",
+                        help="Directory containing the AOP Wiki tables (default: aop_wiki_tables)")
+    parser.add_argument("--host", default="127.0.0.1", help="Host to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on (default: 8080)")
+    parser.add_argument("--cache-mb", type=float, default=256,
+                        help="Maximum total size of the cached ttl documents in MB (default: 256)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Parse the AOP Wiki tables without loading or writing the Parquet snapshot")
+    parser.add_argument("--cache-dir", default=TABLE_CACHE_DIR,
+                        help=f"Directory holding the Parquet snapshots of the tables (default: {TABLE_CACHE_DIR})")
+    args = parser.parse_args()
+
+    service = TTLService(args.tables_dir, int(args.cache_mb * 1e6), not args.no_cache, args.cache_dir)
+    asyncio.run(serve(service, args.host, args.port))
@@ -0,0 +1,108 @@
+import argparse
+import json
+
+import pandas as pd
+
+from write_ttl import AOPTables, TABLE_CACHE_DIR, build_aop, hash_tables, import_tables, partition_tables, \
+    precompute_term_features
+
+######### Statement-level diff of the AOP models built from two snapshots of the AOP Wiki tables
+
+
+def load_snapshot(tables_dir, use_cache=True, cache_dir=None):
+    """
+    Imports a snapshot of the AOP Wiki tables and hashes each AOP's input rows
+    :param tables_dir (str): Directory containing the AOP Wiki tables
+    :param use_cache (bool): Whether to use the Parquet snapshot of the tables, see import_tables()
+    :param cache_dir (str): Directory holding the Parquet snapshots, see import_tables()
+    :return(AOPTables, dict): the partitioned tables and the input hash of each AOP, see hash_tables()
+    """
+    AOP_EC_table, AOP_KE_table, AOP_KER_table, AOP_info = import_tables(tables_dir, use_cache, cache_dir)
+    hashes = hash_tables(AOP_EC_table, AOP_KE_table, AOP_KER_table, AOP_info)
+    precompute_term_features(AOP_EC_table)
+    return AOPTables(*partition_tables(AOP_EC_table, AOP_KE_table, AOP_KER_table), AOP_info), hashes
+
+
+def canonical_statements(document):
+    """
+    Keys each statement of an AOP's model by what it describes, so two models can be compared
+        regardless of the order the statements were written in
+    :param document (TTLDocument): AOP model, see build_aop()
+    :return(dict): statement by key ("title", "class <id>", "individual <id>",
+        "relationship <id1> <id2>" or "object <relationship id>"), sorted by key
+    """
+    statements = {"title": document.title}
+    for prefix, entries in [("class", document.classes), ("individual", document.individuals),
+                            ("object", document.object_statements)]:
+        for key, statement in entries.items():
+            statements[f"{prefix} {key}"] = statement.strip()
+    for (id1, id2), statement in document.relationships.items():
+        # relationships with a missing term are not written to the ttl file
+        if not pd.isna(id1) and not pd.isna(id2) and statement != "":
+            statements[f"relationship {id1} {id2}"] = statement.strip()
+    return dict(sorted(statements.items()))
+
+
+def diff_statements(old, new):
+    """
+    Compares the canonical statements of two versions of an AOP
+    :param old (dict): Canonical statements of the old model, see canonical_statements()
+    :param new (dict): Canonical statements of the new model
+    :return(dict): added and removed statements by key, and the old and new versions of each changed statement
+    """
+    return {"added": {key: new[key] for key in new if key not in old},
+            "removed": {key: old[key] for key in old if key not in new},
+            "changed": {key: {"old": old[key], "new": new[key]} for key in old
+                        if key in new and old[key] != new[key]}}
+
+
+def diff_snapshots(old_tables, old_hashes, new_tables, new_hashes):
+    """
+    Diffs the models of every AOP built from two snapshots. AOPs whose input hashes match are
+        skipped without being built.
+    :param old_tables (AOPTables): Old snapshot, see load_snapshot()
+    :param old_hashes (dict): Input hash of each AOP in the old snapshot
+    :param new_tables (AOPTables): New snapshot
+    :param new_hashes (dict): Input hash of each AOP in the new snapshot
+    :return(dict, int): diff of each AOP that differs by AOP number (see diff_statements()), and the
+        number of AOPs skipped as unchanged
+    """
+    diffs = {}
+    unchanged = 0
+    for AOP_num in sorted(set(old_tables.EC) | set(new_tables.EC)):
+        if old_hashes.get(AOP_num) == new_hashes.get(AOP_num):
+            unchanged += 1
+            continue
+        old = canonical_statements(build_aop(AOP_num, old_tables)) if AOP_num in old_tables.EC else {}
+        new = canonical_statements(build_aop(AOP_num, new_tables)) if AOP_num in new_tables.EC else {}
+        diff = diff_statements(old, new)
+        if any(diff.values()):
+            diff["status"] = "added" if not old else "removed" if not new else "changed"
+            diffs[AOP_num] = diff
+    return diffs, unchanged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Diff the AOP models built from two snapshots of the AOP Wiki "
+                                                 "tables at the statement level")
+    parser.add_argument("old_tables_dir", help="Directory containing the old AOP Wiki tables")
+    parser.add_argument("new_tables_dir", help="Directory containing the new AOP Wiki tables")
+    parser.add_argument("--report", default="snapshot_diff.json",
+                        help="JSON report of the differing statements of each AOP (default: snapshot_diff.json)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Parse the AOP Wiki tables without loading or writing the Parquet snapshots")
+    parser.add_argument("--cache-dir", default=TABLE_CACHE_DIR,
+                        help=f"Directory holding the Parquet snapshots of the tables (default: {TABLE_CACHE_DIR})")
+    args = parser.parse_args()
+
+    old_tables, old_hashes = load_snapshot(args.old_tables_dir, not args.no_cache, args.cache_dir)
+    new_tables, new_hashes = load_snapshot(args.new_tables_dir, not args.no_cache, args.cache_dir)
+    diffs, unchanged = diff_snapshots(old_tables, old_hashes, new_tables, new_hashes)
+    with open(args.report, "w") as f:
+        json.dump({str(AOP_num): diff for AOP_num, diff in diffs.items()}, f, indent=1)
+
+    print(f"{unchanged} AOPs unchanged, {len(diffs)} differ")
+    print(f"{'AOP':>6} {'status':>8} {'added':>6} {'removed':>8} {'changed':>8}")
+    for AOP_num, diff in diffs.items():
+        print(f"{AOP_num:>6} {diff['status']:>8} {len(diff['added']):>6} {len(diff['removed']):>8} "
+              f"{len(diff['changed']):>8}")
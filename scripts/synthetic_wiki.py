@@ -0,0 +1,141 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+######### Synthetic AOP Wiki tables used for benchmarking write_ttl.py
+
+# (source, id prefix, name) templates for the terms drawn into the synthetic wiki
+object_templates = [("PR", "PR:", "receptor {}"), ("CHEBI", "CHEBI:", "compound {}")]
+process_templates = [("GO", "GO:", "receptor {} activity"), ("GO", "GO:", "compound {} biosynthetic process"),
+                     ("MP", "MP:", "abnormal organ {}"), ("HP", "HP:", "tissue {} fibrosis"),
+                     ("MESH", "MESH:D", "cell/tissue injury {}")]
+actions = ["increased", "decreased", np.nan]
+
+
+def create_term_pool(n_terms, seed=0):
+    """
+    Create a pool of object and process/phenotype terms that ECs are drawn from
+    :param n_terms (int): Number of terms of each kind in the pool
+    :param seed (int): Random seed
+    :return(2 lists of tuples): object terms and process/phenotype terms as (source, id, name)
+    """
+    rng = np.random.RandomState(seed)
+    objects = []
+    processes = []
+    for i in range(n_terms):
+        source, prefix, name = object_templates[rng.randint(len(object_templates))]
+        objects.append((source, f"{prefix}{i:07d}", name.format(i)))
+        source, prefix, name = process_templates[rng.randint(len(process_templates))]
+        processes.append((source, f"{prefix}{i:07d}", name.format(rng.randint(n_terms))))
+    return objects, processes
+
+
+def create_synthetic_tables(n_aops=1000, kes_per_aop=6, n_kes=None, n_terms=None, branching=1, term_reuse=2,
+                            seed=0):
+    """
+    Create EC, KE and KER tables in the normalized form returned by import_tables()
+    :param n_aops (int): Number of AOPs
+    :param kes_per_aop (int): Number of KEs in each AOP
+    :param n_kes (int): Number of distinct KEs shared between the AOPs
+    :param n_terms (int): Number of distinct terms of each kind, overrides term_reuse
+    :param branching (int): Maximum number of adjacent KEs that follow each KE. With 1 the AOPs are
+        chains, with more each KE is also linked to up to branching - 1 random later KEs.
+    :param term_reuse (float): Average number of KEs each term is drawn into
+    :param seed (int): Random seed
+    :return(4 dataframes): EC_table, KE_table, KER_table, AOP_info
+    """
+    rng = np.random.RandomState(seed)
+    if n_kes is None:
+        n_kes = max(kes_per_aop, n_aops * kes_per_aop // 3)
+    if n_terms is None:
+        n_terms = max(1, int(n_kes / term_reuse))
+    objects, processes = create_term_pool(n_terms, seed)
+
+    # Event components for each KE, shared by every AOP the KE is used in
+    KE_components = {}
+    for KE in range(1, n_kes + 1):
+        components = []
+        # a few KEs have no event components, as in the real wiki
+        n_components = rng.randint(1, 3) if rng.rand() > 0.03 else 0
+        for i in range(n_components):
+            obj = objects[rng.randint(n_terms)] if rng.rand() < 0.7 else (np.nan, np.nan, np.nan)
+            proc = processes[rng.randint(n_terms)] if rng.rand() < 0.8 or pd.isna(obj[0]) else (np.nan, np.nan, np.nan)
+            components.append((actions[rng.randint(len(actions))],) + obj + proc)
+        KE_components[KE] = components
+
+    EC_rows = []
+    KE_rows = []
+    KER_rows = []
+    info_rows = []
+    relationship = 0
+    for AOP_num in range(1, n_aops + 1):
+        KEs = [int(k) for k in rng.choice(n_kes, kes_per_aop, replace=False) + 1]
+        for i, KE in enumerate(KEs):
+            for component in KE_components[KE]:
+                EC_rows.append((AOP_num, f"Event:{KE}") + component + (KE,))
+            KE_type = "AdverseOutcome" if i == len(KEs) - 1 else "KeyEvent"
+            KE_rows.append((AOP_num, f"Event:{KE}", KE_type, f"Key event {KE}, synthetic", KE))
+        for i in range(len(KEs) - 1):
+            relationship += 1
+            KER_rows.append((AOP_num, relationship, KEs[i], KEs[i + 1], "adjacent"))
+            # extra branches to later KEs keep the KER graph acyclic
+            if branching > 1 and i + 2 < len(KEs):
+                n_branches = min(rng.randint(branching), len(KEs) - i - 2)
+                for j in rng.choice(np.arange(i + 2, len(KEs)), n_branches, replace=False):
+                    relationship += 1
+                    KER_rows.append((AOP_num, relationship, KEs[i], KEs[j], "adjacent"))
+        if len(KEs) > 2:
+            relationship += 1
+            KER_rows.append((AOP_num, relationship, KEs[0], KEs[-1], "non-adjacent"))
+        info_rows.append((AOP_num, f"Synthetic AOP {AOP_num}"))
+
+    AOP_EC_table = pd.DataFrame(EC_rows, columns=["AOP", "Key Event", "Action", "Object Source", "Object ID",
+                                                  "Object Term", "Process/Phenotype Source", "Process/Phenotype ID",
+                                                  "Process/Phenotype Term", "KE"])
+    AOP_KE_table = pd.DataFrame(KE_rows, columns=["AOP", "Key Event", "KE Type", "Adverse Outcome", "KE"])
+    AOP_KER_table = pd.DataFrame(KER_rows, columns=["AOP", "Relationship", "Event1", "Event2", "adjacent"])
+    AOP_info = pd.DataFrame(info_rows, columns=["ID", "Title"]).set_index("ID")
+    return AOP_EC_table, AOP_KE_table, AOP_KER_table, AOP_info
+
+
+def write_synthetic_wiki(tables_dir, n_aops=1000, kes_per_aop=6, n_kes=None, n_terms=None, branching=1,
+                         term_reuse=2, seed=0):
+    """
+    Write a synthetic AOP Wiki as the raw table files read by import_tables(), with the
+        Aop:, Event: and Relationship: ID prefixes of the AOP Wiki export
+    :param tables_dir (str): Directory to write aop_ke_ec.csv, aop_ke_mie_ao.tsv, aop_ke_ker.tsv
+        and AOP_info.csv to
+    :params: see create_synthetic_tables()
+    """
+    AOP_EC_table, AOP_KE_table, AOP_KER_table, AOP_info = create_synthetic_tables(n_aops, kes_per_aop, n_kes,
+                                                                                  n_terms, branching, term_reuse,
+                                                                                  seed)
+    os.makedirs(tables_dir, exist_ok=True)
+    for table in [AOP_EC_table, AOP_KE_table, AOP_KER_table]:
+        table["AOP"] = "Aop:" + table["AOP"].astype(str)
+    for column in ["Event1", "Event2"]:
+        AOP_KER_table[column] = "Event:" + AOP_KER_table[column].astype(str)
+    AOP_KER_table["Relationship"] = "Relationship:" + AOP_KER_table["Relationship"].astype(str)
+
+    AOP_EC_table.drop(columns="KE").to_csv(f"{tables_dir}/aop_ke_ec.csv", index=False)
+    AOP_KE_table.drop(columns="KE").to_csv(f"{tables_dir}/aop_ke_mie_ao.tsv", sep="\t", index=False)
+    AOP_KER_table.to_csv(f"{tables_dir}/aop_ke_ker.tsv", sep="\t", index=False)
+    AOP_info.to_csv(f"{tables_dir}/AOP_info.csv")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic AOP Wiki for benchmarking write_ttl.py")
+    parser.add_argument("tables_dir", help="Directory to write the AOP Wiki tables to")
+    parser.add_argument("--aops", type=int, default=1000, help="Number of AOPs (default: 1000)")
+    parser.add_argument("--kes-per-aop", type=int, default=6, help="Number of KEs in each AOP (default: 6)")
+    parser.add_argument("--branching", type=int, default=1,
+                        help="Maximum number of adjacent KEs that follow each KE (default: 1, chains)")
+    parser.add_argument("--term-reuse", type=float, default=2,
+                        help="Average number of KEs each term is drawn into (default: 2)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    args = parser.parse_args()
+
+    write_synthetic_wiki(args.tables_dir, args.aops, args.kes_per_aop, branching=args.branching,
+                         term_reuse=args.term_reuse, seed=args.seed)
@@ -0,0 +1,231 @@
+import argparse
+import glob
+import importlib.util
+import json
+import os
+import regex as re
+from concurrent.futures import ProcessPoolExecutor
+
+######### Validation of the ttl files written by write_ttl.py
+
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+NAMED_INDIVIDUAL = "http://www.w3.org/2002/07/owl#NamedIndividual"
+OBJECT_PROPERTY = "http://www.w3.org/2002/07/owl#ObjectProperty"
+RO_PREFIX = "http://purl.obolibrary.org/obo/RO_"
+
+# Tokens of the subset of Turtle written by write_ttl.py
+turtle_token = re.compile(r'''
+    (?P<space>\s+|\#[^\n]*)
+  | (?P<directive>@prefix|@base)
+  | (?P<iri><[^<>"{}|^`\\\s]*>)
+  | (?P<literal>"(?:[^"\\\n]|\\.)*"(?:@[A-Za-z-]+)?)
+  | (?P<datatype>\^\^)
+  | (?P<pname>(?:[A-Za-z][\w.-]*)?:(?:[\w%-]|\.(?=[\w%-]))*)
+  | (?P<a>a(?=[\s<]))
+  | (?P<punct>[.;,])
+''', re.VERBOSE)
+
+
+class TurtleSyntaxError(ValueError):
+    """
+    Raised by parse_turtle() for text it cannot parse
+    """
+
+
+def tokenize_turtle(text):
+    """
+    Splits ttl text into tokens
+    :param text (str): ttl document
+    :return(list of tuples): (kind, value, line number) of each token, without whitespace and comments
+    """
+    tokens = []
+    pos = 0
+    line = 1
+    while pos < len(text):
+        match = turtle_token.match(text, pos)
+        if match is None:
+            raise TurtleSyntaxError(f"line {line}: unexpected {text[pos:pos + 20]!r}")
+        if match.lastgroup != "space":
+            tokens.append((match.lastgroup, match.group(), line))
+        line += match.group().count("\n")
+        pos = match.end()
+    return tokens
+
+
+def parse_turtle(text):
+    """
+    Parses the subset of Turtle written by write_ttl.py (prefix and base directives, IRIs,
+        prefixed names, typed literals and predicate/object lists). Used when rdflib is not installed.
+    :param text (str): ttl document
+    :return(list of tuples): distinct (subject, predicate, object) triples, with IRIs expanded and
+        literals as written apart from their datatype IRI, which is expanded
+    """
+    tokens = tokenize_turtle(text)
+    prefixes = {}
+    triples = []
+
+    def term(i):
+        """
+        :return(str, int): the term starting at token i and the index of the token after it
+        """
+        if i >= len(tokens):
+            raise TurtleSyntaxError("unexpected end of document, expected a term")
+        kind, value, line = tokens[i]
+        if kind == "iri":
+            return value[1:-1], i + 1
+        if kind == "pname":
+            prefix, local = value.split(":", 1)
+            if prefix not in prefixes:
+                raise TurtleSyntaxError(f"line {line}: undeclared prefix {prefix!r}")
+            return prefixes[prefix] + local, i + 1
+        if kind == "a":
+            return RDF_TYPE, i + 1
+        if kind == "literal":
+            if i + 1 < len(tokens) and tokens[i + 1][0] == "datatype":
+                if value.endswith('"') and i + 2 < len(tokens) and tokens[i + 2][0] in ("iri", "pname"):
+                    datatype, i = term(i + 2)
+                    return f"{value}^^<{datatype}>", i
+                raise TurtleSyntaxError(f"line {line}: malformed datatype of {value!r}")
+            return value, i + 1
+        raise TurtleSyntaxError(f"line {line}: expected a term, found {value!r}")
+
+    def expect(i, value):
+        if i >= len(tokens):
+            raise TurtleSyntaxError(f"unexpected end of document, expected {value!r}")
+        if tokens[i][1] != value:
+            raise TurtleSyntaxError(f"line {tokens[i][2]}: expected {value!r}, found {tokens[i][1]!r}")
+
+    i = 0
+    while i < len(tokens):
+        kind, value, line = tokens[i]
+        if kind == "directive":
+            if value == "@prefix":
+                if i + 2 >= len(tokens) or tokens[i + 1][0] != "pname" or not tokens[i + 1][1].endswith(":") \
+                        or tokens[i + 2][0] != "iri":
+                    raise TurtleSyntaxError(f"line {line}: malformed @prefix")
+                prefixes[tokens[i + 1][1][:-1]] = tokens[i + 2][1][1:-1]
+                i += 3
+            else:
+                if i + 1 >= len(tokens) or tokens[i + 1][0] != "iri":
+                    raise TurtleSyntaxError(f"line {line}: malformed @base")
+                i += 2
+            expect(i, ".")
+            i += 1
+            continue
+
+        subject, i = term(i)
+        while True:
+            if i + 1 >= len(tokens):
+                raise TurtleSyntaxError(f"line {line}: unterminated statement")
+            predicate, i = term(i)
+            while True:
+                obj, i = term(i)
+                triples.append((subject, predicate, obj))
+                if i < len(tokens) and tokens[i][1] == ",":
+                    i += 1
+                    continue
+                break
+            # the grammar allows empty elements after ";", e.g. "<s> <p> <o> ; ."
+            if i < len(tokens) and tokens[i][1] == ";":
+                while i < len(tokens) and tokens[i][1] == ";":
+                    i += 1
+                if i < len(tokens) and tokens[i][1] == ".":
+                    break
+                continue
+            break
+        expect(i, ".")
+        i += 1
+    # a graph holds each triple once
+    return list(dict.fromkeys(triples))
+
+
+def parse_turtle_rdflib(text):
+    """
+    Parses ttl text with rdflib
+    :param text (str): ttl document
+    :return(list of tuples): (subject, predicate, object) triples as strings
+    """
+    import rdflib
+
+    graph = rdflib.Graph()
+    graph.parse(data=text, format="turtle")
+    return [tuple(str(node) for node in triple) for triple in graph]
+
+
+def check_triples(triples):
+    """
+    Checks that every individual referenced by an RO relationship is declared as an
+        owl:NamedIndividual, and that every RO predicate is declared as an owl:ObjectProperty
+    :param triples (list of tuples): (subject, predicate, object) triples of a document
+    :return(2 lists): undeclared individuals and undeclared RO predicates, sorted
+    """
+    individuals = {s for s, p, o in triples if p == RDF_TYPE and o == NAMED_INDIVIDUAL}
+    properties = {s for s, p, o in triples if p == RDF_TYPE and o == OBJECT_PROPERTY}
+    referenced = set()
+    predicates = set()
+    for s, p, o in triples:
+        if p.startswith(RO_PREFIX):
+            predicates.add(p)
+            referenced.update([s, o])
+    return sorted(referenced - individuals), sorted(predicates - properties)
+
+
+def validate_ttl_file(path, use_rdflib=None):
+    """
+    Validates one ttl file: its syntax, that the individuals it references are declared and that
+        its RO predicates are declared as object properties
+    :param path (str): ttl file to validate
+    :param use_rdflib (bool): Whether to parse with rdflib, by default if it is installed
+    :return(dict): validation result of the file
+    """
+    if use_rdflib is None:
+        use_rdflib = importlib.util.find_spec("rdflib") is not None
+    result = {"file": path, "parser": "rdflib" if use_rdflib else "builtin", "valid": True, "syntax_error": None,
+              "triples": 0, "undeclared_individuals": [], "undeclared_properties": []}
+    with open(path) as f:
+        text = f.read()
+    try:
+        triples = parse_turtle_rdflib(text) if use_rdflib else parse_turtle(text)
+    except Exception as e:
+        result["valid"] = False
+        result["syntax_error"] = f"{type(e).__name__}: {e}"
+        return result
+    result["triples"] = len(triples)
+    result["undeclared_individuals"], result["undeclared_properties"] = check_triples(triples)
+    result["valid"] = not result["undeclared_individuals"] and not result["undeclared_properties"]
+    return result
+
+
+def write_report(path, results):
+    """
+    Writes the validation results of many files to a JSON report
+    :param path (str): Report file to write
+    :param results (list of dicts): Results from validate_ttl_file()
+    :return(int): number of invalid files
+    """
+    invalid = [result for result in results if not result["valid"]]
+    report = {"files": len(results), "invalid": len(invalid),
+              "results": sorted(results, key=lambda result: (result["valid"], result["file"]))}
+    with open(path, "w") as f:
+        json.dump(report, f, indent=1)
+    return len(invalid)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Validate the ttl files written by write_ttl.py")
+    parser.add_argument("output_dir", help="Directory containing the ttl files")
+    parser.add_argument("--report", default="validation.json",
+                        help="JSON report to write (default: validation.json)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument("--builtin", action="store_true",
+                        help="Use the built-in parser even if rdflib is installed")
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(f"{args.output_dir}/*.ttl"))
+    use_rdflib = not args.builtin and importlib.util.find_spec("rdflib") is not None
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        results = list(executor.map(validate_ttl_file, paths, [use_rdflib] * len(paths),
+                                    chunksize=max(1, len(paths) // (args.workers * 4))))
+    n_invalid = write_report(args.report, results)
+    print(f"Validated {len(paths)} files: {n_invalid} invalid, report written to {args.report}")
@@ -2,64 +2,83 @@ import pandas as pd
 import regex as re
 import numpy as np
 import traceback
+import functools
+import itertools
+import collections
 import os
+import sys
 import datetime as dt
+import argparse
+import dataclasses
+import contextlib
+import gzip
+import importlib.util
+import hashlib
+import json
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
 from urllib.parse import quote
 
+import edge_index
+import validate_ttl
+
 ######### Functions
 
 phenotype_ontologies = ["MP", "HP", "VT"]  # ontologies generally asociated with phenotype terms
 process_ontologies = ["GO"]  # ontologies generally associated with process terns
 
+# Versions recorded in the incremental build manifest. Increment RELATIONSHIP_TREE_VERSION when the
+#   decisions made by get_relationship() change and TTL_OUTPUT_VERSION when the ttl output changes
+#   for the same input, so that incremental runs rebuild every AOP.
+RELATIONSHIP_TREE_VERSION = 2
+TTL_OUTPUT_VERSION = 2
+
 
-def get_relationship(action1, term1, source1, ECtype1, action2, term2, source2, ECtype2):
+def relationship_tree(ECtype1, object2, source_type1, source_type2, actions, osis2, biosynthetic2, contains):
     """
-    Gives suggestions for the ontological relationship between Term1 AND Term2 based on the
-        relationship decision tree.
-    Takes two terms, their EC type and source information, and returns a pipe-separated
-    list of suggested ontological relationships (if there are any) between term 1 and term 2
-    :param action1(str): Action for the EC, if available
-    :param term1(str): Term 1 for comparison
-    :param source1(str): Ontology source of Term 1
-    :param ECtype1(str): Term 1's role in the EC (object, process/phenotype)
-    :param action2(str): Term 2 for comparison
-    :param term2(str): Ontology source of Term 2
-    :param source2(str): Term 2's role in the EC (object, process/phenotype)
-    :param ECtype2(str): Term 2's role in the EC (object, process/phenotype)
+    The relationship decision tree. Gives suggestions for the ontological relationship between
+        Term1 and Term2 from the features of the two terms (see relationship_features()).
+        get_relationship() does not walk the tree directly, it looks the features up in
+        RELATIONSHIP_RULES, which is built from this function for every combination of features.
+    :param ECtype1 (str): Term 1's role in the EC (object, process/phenotype)
+    :param object2 (bool): Whether Term 2 is an object
+    :param source_type1 (str): "process", "phenotype" or "other", the kind of ontology Term 1 is from
+    :param source_type2 (str): "process", "phenotype" or "other", the kind of ontology Term 2 is from
+    :param actions (str): "same" or "opposite" if both actions are increased/decreased, otherwise None
+    :param osis2 (bool): Whether Term 2 contains "osis"
+    :param biosynthetic2 (bool): Whether Term 2 contains "biosynthetic" or "generation"
+    :param contains (bool): Whether Term 2 contains Term 1
     :return (str):  pipe-separated list of suggested ontological relationships
     """
-    if pd.isna(term1) or pd.isna(term2):
-        return ""
-
     # If EC1 is an Object, go through the decision tree to find suggested relationships
     # based on EC2's type and oontology
     if ECtype1 == "Object":
-        if ECtype2 == "Object":
+        if object2:
             return "RO_0002566|RO_0002559"  # Causally_incluences:Causally_influenced_by
-        # elif source2 in phenotype_ontologies or "osis" in term2:
-        elif source2 in process_ontologies:
-            if "biosynthetic" in term2 or "generation" in term2:
+        elif source_type2 == "process":
+            if biosynthetic2:
                 return "RO_0002353"  # :Output_of
             else:
-                if term1 in term2:
+                if contains:
                     return "RO_0002327"  #:Enables
                 else:
                     return "RO_0002331|RO_0002327|RO_0002353|RO_0002428"  # RO_0002331:Involved_in|RO_0002327:Enables|RO_0002353:Output_of|RO_0002428:Involved_in_regulation_of
 
-        elif source2 in phenotype_ontologies or "osis" in term2:
+        elif source_type2 == "phenotype" or osis2:
             return "RO_0002610|RO_0000053"  # RO_0002610:Correlated_with|RO_0000053:Has_characteristic
         else:
             return "RO_0002410"  # Causally related to
     # If EC1 is a Process/Phenotype, go through the decision tree to find suggested relationships
     # based on EC2's type and oontology
     elif ECtype1 == "Process/Phenotype":
-        if source1 in process_ontologies or "osis" in term2:
-            if ECtype2 == "Object":
+        if source_type1 == "process" or osis2:
+            if object2:
                 return "RO_0002234|RO_0002233|RO_0000057|RO_0002332"  # RO_0002234:Has_output|RO_0002233:Has_input|RO_0000057:Has_participant|RO_0002332:Regulates_levels_of
             else:
-                if source2 in process_ontologies or "osis" in term2:
-                    if action1 in ["increased", "decreased"] and action2 in ["increased", "decreased"]:
-                        if action1 == action2:
+                if source_type2 == "process" or osis2:
+                    if actions is not None:
+                        if actions == "same":
                             return "RO_0002213"  #:Positively_regulates
                         else:
                             return "RO_0002212"  #:Negatively_regulates
@@ -67,10 +86,10 @@ def get_relationship(action1, term1, source1, ECtype1, action2, term2, source2,
                         return "RO_0002410"  #:Causally_related_to
                 else:
                     return "RO_0019000"  #:Regulates_characteristic
-        elif source1 in phenotype_ontologies:
-            if ECtype2 == "Object":
+        elif source_type1 == "phenotype":
+            if object2:
                 return "RO_0000052"  #:Characteristic_of
-            elif source2 in process_ontologies or "osis" in term2:
+            elif source_type2 == "process" or osis2:
                 return "RO_0004024|RO_0004021"  # RO_0004024:Disease_causes_disruption_of|RO_0004021:Disease_has_basis_in_disruption_of
             else:
                 return "RO_0003303|RO_0002610"  # RO_0003303:Causes_condition|RO_0002610:Correlated_with
@@ -78,13 +97,173 @@ def get_relationship(action1, term1, source1, ECtype1, action2, term2, source2,
             return "RO_0002410"  # Causally related to
 
 
+# Labels of the relationships suggested by the decision tree, used in the curator review table
+relationship_labels = {"RO_0000052": "characteristic of", "RO_0000053": "has characteristic",
+                       "RO_0000057": "has participant", "RO_0002212": "negatively regulates",
+                       "RO_0002213": "positively regulates", "RO_0002233": "has input", "RO_0002234": "has output",
+                       "RO_0002327": "enables", "RO_0002331": "involved in", "RO_0002332": "regulates levels of",
+                       "RO_0002353": "output of", "RO_0002410": "causally related to",
+                       "RO_0002428": "involved in regulation of", "RO_0002559": "causally influenced by",
+                       "RO_0002566": "causally influences", "RO_0002610": "correlated with",
+                       "RO_0003303": "causes condition", "RO_0004021": "disease has basis in disruption of",
+                       "RO_0004024": "disease causes disruption of", "RO_0019000": "regulates characteristic"}
+
+
+def get_source_type(source):
+    """
+    Returns the kind of ontology a term is from
+    :param source (str): Ontology source of the term
+    :return (str): "process", "phenotype" or "other"
+    """
+    if source in process_ontologies:
+        return "process"
+    elif source in phenotype_ontologies:
+        return "phenotype"
+    return "other"
+
+
+# Feature flags of a term name used by the relationship decision tree
+TermFeatures = collections.namedtuple("TermFeatures", ["osis", "biosynthetic"])
+
+# Feature flags of every term name seen so far, see get_term_features()
+term_features = {}
+
+
+def get_term_features(term):
+    """
+    Returns the feature flags of a term name, extracting them the first time the name is seen
+    :param term (str): Term name, as in the EC table
+    :return(TermFeatures): whether the name contains "osis" (disease suffix), and whether it
+        contains "biosynthetic" or "generation"
+    """
+    features = term_features.get(term)
+    if features is None:
+        features = TermFeatures("osis" in term, "biosynthetic" in term or "generation" in term)
+        term_features[term] = features
+    return features
+
+
+def precompute_term_features(AOP_EC_table):
+    """
+    Extracts the feature flags of every distinct object and process/phenotype term in the EC table
+        once, so classifying term pairs only looks the flags up
+    :param AOP_EC_table(DF): Full EC table from AOP Wiki
+    """
+    for column in ["Object Term", "Process/Phenotype Term"]:
+        for term in AOP_EC_table[column].dropna().unique():
+            get_term_features(term)
+
+
+def containment_index(term_pairs):
+    """
+    Finds the term pairs in which Term 2 contains Term 1, checking each distinct pair once
+    :param term_pairs (iterable): (Term 1, Term 2) name pairs, e.g. every pair compared in an AOP
+    :return(set): the pairs in which Term 2 contains Term 1
+    """
+    return {(term1, term2) for term1, term2 in set(term_pairs)
+            if not pd.isna(term1) and not pd.isna(term2) and term1 in term2}
+
+
+def relationship_features(action1, term1, source1, ECtype1, action2, term2, source2, ECtype2, contains=None):
+    """
+    Reduces two terms to the features the relationship decision tree depends on
+    :param contains (bool): Whether Term 2 contains Term 1, see containment_index(). Checked
+        directly if None.
+    :return (tuple): key of RELATIONSHIP_RULES, see relationship_tree() for the features
+    """
+    if action1 in ["increased", "decreased"] and action2 in ["increased", "decreased"]:
+        actions = "same" if action1 == action2 else "opposite"
+    else:
+        actions = None
+    ECtype1 = ECtype1 if ECtype1 in ["Object", "Process/Phenotype"] else None
+    if contains is None:
+        contains = term1 in term2
+    features2 = get_term_features(term2)
+    return (ECtype1, ECtype2 == "Object", get_source_type(source1), get_source_type(source2), actions,
+            features2.osis, features2.biosynthetic, contains)
+
+
+# The relationship decision tree compiled into a table of suggested relationship IDs for every
+#   combination of term features
+RELATIONSHIP_RULES = {features: relationship_tree(*features) for features in itertools.product(
+    ["Object", "Process/Phenotype", None], [True, False], ["process", "phenotype", "other"],
+    ["process", "phenotype", "other"], ["same", "opposite", None], [True, False], [True, False], [True, False])}
+
+TERM_IRI_CACHE_SIZE = 65536  # number of term names kept in the quoted term IRI cache
+
+
+def get_relationship(action1, term1, source1, ECtype1, action2, term2, source2, ECtype2, contains=None):
+    """
+    Gives suggestions for the ontological relationship between Term1 AND Term2 based on the
+        relationship decision tree.
+    Takes two terms, their EC type and source information, and returns a pipe-separated
+    list of suggested ontological relationships (if there are any) between term 1 and term 2
+    :param action1(str): Action for the EC, if available
+    :param term1(str): Term 1 for comparison
+    :param source1(str): Ontology source of Term 1
+    :param ECtype1(str): Term 1's role in the EC (object, process/phenotype)
+    :param action2(str): Term 2 for comparison
+    :param term2(str): Ontology source of Term 2
+    :param source2(str): Term 2's role in the EC (object, process/phenotype)
+    :param ECtype2(str): Term 2's role in the EC (object, process/phenotype)
+    :param contains (bool): Whether Term 2 contains Term 1, see relationship_features()
+    :return (str):  pipe-separated list of suggested ontological relationships
+    """
+    if pd.isna(term1) or pd.isna(term2):
+        return ""
+    return RELATIONSHIP_RULES[relationship_features(action1, term1, source1, ECtype1, action2, term2, source2,
+                                                    ECtype2, contains)]
+
+
+# Class and individual statements of every (id, name, source) term rendered so far. Shared by all
+#   AOPs built in this process, so a term used in many AOPs is only rendered and stored once.
+term_registry = {}
+
+
 def process_term(input_id, name, source):
     '''
-    Takes an ontology term and id and returns ttl class and instance statements
+    Takes an ontology term and id and returns ttl class and instance statements. Statements are
+        rendered once per term and then looked up in term_registry.
     :param input_id (str): Term ID
     :param name(str): Term name
     :return(2 dicts): Dictionaries of statements declaring classes and individuals
     '''
+    key = (input_id, name, source)
+    statements = term_registry.get(key)
+    if statements is None:
+        statements = term_registry[key] = render_term(input_id, name, source)
+    return statements
+
+
+def clear_term_caches():
+    '''
+    Empties term_registry and term_features. Called after each AOP when the tables are streamed, so
+        memory use does not grow with the number of distinct terms in the tables.
+    '''
+    term_registry.clear()
+    term_features.clear()
+
+
+def render_term(input_id, name, source):
+    '''
+    Renders the ttl class and instance statements of an ontology term for process_term()
+    :param input_id (str): Term ID
+    :param name(str): Term name
+    :param source(str): Ontology source of the term
+    :return(2 str): interned class and individual statements
+    '''
+    class_statement, individuals_statement = format_term(input_id, name, source)
+    return (sys.intern(class_statement), sys.intern(individuals_statement))
+
+
+def format_term(input_id, name, source):
+    '''
+    Formats the ttl class and instance statements of an ontology term, without interning them
+    :param input_id (str): Term ID
+    :param name(str): Term name
+    :param source(str): Ontology source of the term
+    :return(2 str): class and individual statements
+    '''
     if ":" in input_id:
         str_1 = input_id.split(":")[0]
         str_2 = input_id.split(":")[1]
@@ -115,83 +294,451 @@ def get_object_statement(input_id_str, object_statements):
     return object_statements
 
 
-def get_relationship_statement(action1, term1, source1, ECtype1, action2, term2, source2, ECtype2):
+def render_predicates(rel_id_str):
+    '''
+    Splits a pipe-separated list of relationship IDs and renders their predicate IRIs
+    :param rel_id_str (str): pipe-separated relationship IDs, see get_relationship()
+    :return(tuple, tuple): the relationship IDs and their predicate IRIs
+    '''
+    if pd.isna(rel_id_str):
+        rel_id_str = "RO_0002410"
+    rel_ids = tuple(rel_id_str.split("|"))
+    return rel_ids, tuple(f"<http://purl.obolibrary.org/obo/{rel_id}>" for rel_id in rel_ids)
+
+
+# Predicates of a pair of terms of which either is missing
+MISSING_TERM_PREDICATES = render_predicates("")
+
+
+@functools.lru_cache(maxsize=len(RELATIONSHIP_RULES))
+def relationship_predicates(features):
+    '''
+    Looks up the suggested relationships for a combination of term features and renders their
+        predicate IRIs. Cached by features, so every term pair with the same features costs one lookup.
+    :param features (tuple): key of RELATIONSHIP_RULES, see relationship_features()
+    :return(tuple, tuple): the suggested relationship IDs and their predicate IRIs
+    '''
+    return render_predicates(RELATIONSHIP_RULES[features])
+
+
+@functools.lru_cache(maxsize=TERM_IRI_CACHE_SIZE)
+def quote_term(term):
+    '''
+    Quotes a term name for use in an individual's IRI
+    :param term (str): Term name
+    :return(str): the quoted name, with "/" escaped as well
+    '''
+    return re.sub(r"\/", "%2F", quote(term))
+
+
+def render_relationship(action1, term1, source1, ECtype1, action2, term2, source2, ECtype2, contains=None):
+    '''
+    Looks up the suggested relationships between two terms and renders the relationship statement
+        from their cached predicate IRIs. The terms are classified as they are and only quoted for the IRI.
+    :return(str, tuple): ttl relationship statement and the suggested relationship IDs
+    '''
+    if pd.isna(term1) or pd.isna(term2):
+        rel_ids, predicates = MISSING_TERM_PREDICATES
+    else:
+        rel_ids, predicates = relationship_predicates(relationship_features(action1, term1, source1, ECtype1, action2,
+                                                                            term2, source2, ECtype2, contains))
+    term2 = quote_term(term2)
+    return " ;\n".join(f"\t{predicate} :{term2}" for predicate in predicates), rel_ids
+
+
+def relationship_cache_info():
+    '''
+    Returns the hit and miss counts of the relationship predicate cache
+    :return(namedtuple): hits, misses, maxsize and currsize of the cache
+    '''
+    return relationship_predicates.cache_info()
+
+
+def get_relationship_statement(action1, term1, source1, ECtype1, action2, term2, source2, ECtype2, contains=None):
     '''
     Determines a relationship term given two terms and their ontology ids. Returns a ttl action/relationship statement
+    :param contains (bool): Whether Term 2 contains Term 1, see relationship_features()
     :return: ttl relationship statement as a string
     '''
     # rel_id = "RO_0000057"
     if action1 != "" and not pd.isna(term2):
-        # term2 = re.sub(r"\s", "_", term2)
-        # term2 = re.sub(r"\s", "_", term2)
-        term2 = quote(term2)
-        term2 = re.sub(r"\/", "%2F", term2)
-        rel_id_str = get_relationship(action1, term1, source1, ECtype1, action2, term2, source2, ECtype2)
-        if pd.isna(rel_id_str):
-            return (f"\t<http://purl.obolibrary.org/obo/RO_0002410> :{term2}\n\n")
-        rel_id_list = rel_id_str.split("|")
-
-        if len(rel_id_list) > 1:
-            # relationship_statement = f"\t<http://purl.obolibrary.org/obo/{rel_id_list[0]}> :{term2} ;\n"
-            relationship_statement = f"\t<http://purl.obolibrary.org/obo/{rel_id_list[0]}> :{term2}"
-            for rel_id in rel_id_list[1:]:
-                relationship_statement_seg = f"\t<http://purl.obolibrary.org/obo/{rel_id}> :{term2}"
-                # relationship_statement = relationship_statement + ";\n" + "+" + relationship_statement_seg + ''
-                relationship_statement = relationship_statement + " ;\n" + relationship_statement_seg + ""
-        else:
-            relationship_statement = f"\t<http://purl.obolibrary.org/obo/{rel_id_list[0]}> :{term2}"
-
-        # relationship_statement = relationship_statement + " \n\n"
-        return (relationship_statement, rel_id_list)
+        relationship_statement, rel_ids = render_relationship(action1, term1, source1, ECtype1, action2, term2,
+                                                              source2, ECtype2, contains)
+        return (relationship_statement, list(rel_ids))
     else:
         return ("", [])
 
 
-def import_tables():
+# AOP Wiki table files in the aop_wiki_tables directory, with their separators
+table_files = {"EC": ("aop_ke_ec.csv", ","),
+               "KE": ("aop_ke_mie_ao.tsv", "\t"),
+               "KER": ("aop_ke_ker.tsv", "\t"),
+               "info": ("AOP_info.csv", ",")}
+table_cache_version = 1  # increment when read_tables() changes how the tables are normalized
+
+
+def strip_prefix_to_int(column, prefix):
     """
-    Import AOP Wiki tables from the aop_wiki_tables_directory
-    :return(3 dataframes): returns dataframes of the EC_table, KE_table, KER_table
+    Removes a prefix such as "Event:" or "Aop:" from a column of IDs and converts the IDs to integers
+    :param column (Series): Column of IDs
+    :param prefix (str): Prefix to remove
+    :return(Series): integer IDs
     """
-    # Import AOP EC table data
-    os.chdir("/Users/mmandal/Library/CloudStorage/OneDrive-ResearchTriangleInstitute/projects/NCATS_AOP")
-    AOP_EC_table = pd.read_csv("aop_wiki_tables/aop_ke_ec.csv")
-    AOP_KE_table = pd.read_csv("aop_wiki_tables/aop_ke_mie_ao.tsv", sep="\t")
-    AOP_KER_table = pd.read_csv("aop_wiki_tables/aop_ke_ker.tsv", sep="\t")
-    AOP_info = pd.read_csv("aop_wiki_tables/AOP_info.csv")
-    AOP_info = AOP_info.set_index("ID")
+    return column.str.replace(prefix, "", regex=False).astype("int64")
 
-    # Convert KE, AOP, Evennt, and relationshihp columns to integers
-    AOP_EC_table["KE"] = [int(re.sub(r"Event\:", "", x)) for x in AOP_EC_table["Key Event"]]
-    AOP_EC_table['AOP'] = [int(re.sub(r"Aop\:", "", x)) for x in AOP_EC_table["AOP"]]
 
-    AOP_KER_table['AOP'] = [int(re.sub(r"Aop\:", "", x)) for x in AOP_KER_table["AOP"]]
-    AOP_KER_table["Event1"] = [int(re.sub(r"Event\:", "", x)) for x in AOP_KER_table["Event1"]]
-    AOP_KER_table["Event2"] = [int(re.sub(r"Event\:", "", x)) for x in AOP_KER_table["Event2"]]
-    AOP_KER_table["Relationship"] = [int(re.sub(r"Relationship\:", "", x)) for x in AOP_KER_table["Relationship"]]
+# dtypes of the ID columns of the EC, KE and KER tables, read as strings so their prefixes can be removed
+table_dtypes = {"EC": {"AOP": str, "Key Event": str},
+                "KE": {"AOP": str, "Key Event": str},
+                "KER": {"AOP": str, "Event1": str, "Event2": str, "Relationship": str}}
+
 
-    AOP_KE_table["KE"] = [int(re.sub(r"Event\:", "", x)) for x in AOP_KE_table["Key Event"]]
-    AOP_KE_table['AOP'] = [int(re.sub(r"Aop\:", "", x)) for x in AOP_KE_table["AOP"]]
+def normalize_table(name, table):
+    """
+    Converts the KE, AOP, Event and Relationship ID columns of an EC, KE or KER table to integers
+    :param name (str): "EC", "KE" or "KER"
+    :param table(DF): Table as read from its file, or a chunk of it
+    :return(DF): the normalized table
+    """
+    # Convert KE, AOP, Evennt, and relationshihp columns to integers
+    if name == "EC":
+        table["KE"] = strip_prefix_to_int(table["Key Event"], "Event:")
+        table['AOP'] = strip_prefix_to_int(table["AOP"], "Aop:")
+    elif name == "KER":
+        table['AOP'] = strip_prefix_to_int(table["AOP"], "Aop:")
+        table["Event1"] = strip_prefix_to_int(table["Event1"], "Event:")
+        table["Event2"] = strip_prefix_to_int(table["Event2"], "Event:")
+        table["Relationship"] = strip_prefix_to_int(table["Relationship"], "Relationship:")
+    elif name == "KE":
+        table["KE"] = strip_prefix_to_int(table["Key Event"], "Event:")
+        table['AOP'] = strip_prefix_to_int(table["AOP"], "Aop:")
+    return table
+
+
+def read_tables(tables_dir):
+    """
+    Reads the AOP Wiki tables from their CSV/TSV files and normalizes their ID columns
+    :param tables_dir (str): Directory containing the AOP Wiki tables
+    :return(4 dataframes): returns dataframes of the EC_table, KE_table, KER_table and AOP_info
+    """
+    source_dtypes = {"Object Source": "category", "Process/Phenotype Source": "category"}
+    tables = []
+    for name in ["EC", "KE", "KER"]:
+        filename, sep = table_files[name]
+        dtype = {**table_dtypes[name], **source_dtypes} if name == "EC" else table_dtypes[name]
+        tables.append(normalize_table(name, pd.read_csv(f"{tables_dir}/{filename}", sep=sep, dtype=dtype)))
+    AOP_EC_table, AOP_KE_table, AOP_KER_table = tables
+    AOP_info = pd.read_csv(f"{tables_dir}/AOP_info.csv")
+    AOP_info = AOP_info.set_index("ID")
 
     return AOP_EC_table, AOP_KE_table, AOP_KER_table, AOP_info
 
 
+def hash_file(path):
+    """
+    Returns the SHA-1 hex digest of a file's contents
+    :param path (str): File to hash
+    :return(str): hex digest
+    """
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_table_cache(tables_dir, cache_dir):
+    """
+    Loads the normalized tables from the Parquet snapshot in cache_dir if it was made from the
+        current table files. Files are compared by size and modification time, and by content
+        hash if those changed. If the hashes of such files still match, their new size and
+        modification time are recorded so later runs do not hash them again.
+    :param tables_dir (str): Directory containing the AOP Wiki tables
+    :param cache_dir (str): Directory containing the snapshot
+    :return(tuple): EC_table, KE_table, KER_table and AOP_info, or None if the snapshot is missing or stale
+    """
+    try:
+        with open(f"{cache_dir}/sources.json") as f:
+            cached = json.load(f)
+    except OSError:
+        return None
+    if cached["version"] != table_cache_version:
+        return None
+    refreshed = False  # whether a file was touched without changing its contents
+    for name, (filename, sep) in table_files.items():
+        path = f"{tables_dir}/{filename}"
+        stat = os.stat(path)
+        source = cached["sources"][name]
+        if (stat.st_size, stat.st_mtime_ns) != (source["size"], source["mtime_ns"]):
+            if hash_file(path) != source["sha1"]:
+                return None
+            source["size"], source["mtime_ns"] = stat.st_size, stat.st_mtime_ns
+            refreshed = True
+    tables = tuple(pd.read_parquet(f"{cache_dir}/{name}.parquet") for name in table_files)
+    if refreshed:
+        try:
+            atomic_write(f"{cache_dir}/sources.json", json.dumps(cached))
+        except OSError:
+            pass  # the files are hashed again next time
+    return tables
+
+
+def write_table_cache(tables_dir, cache_dir, tables):
+    """
+    Writes the normalized tables to a Parquet snapshot in cache_dir, with the size, modification time
+        and content hash of the table files they were read from
+    :param tables_dir (str): Directory containing the AOP Wiki tables
+    :param cache_dir (str): Directory to write the snapshot to
+    :param tables (tuple): EC_table, KE_table, KER_table and AOP_info
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    # sources.json is written last, so a snapshot that was only partly written is never loaded
+    if os.path.exists(f"{cache_dir}/sources.json"):
+        os.remove(f"{cache_dir}/sources.json")
+    sources = {}
+    for name, (filename, sep) in table_files.items():
+        path = f"{tables_dir}/{filename}"
+        stat = os.stat(path)
+        sources[name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": hash_file(path)}
+    for name, table in zip(table_files, tables):
+        table.to_parquet(f"{cache_dir}/{name}.parquet")
+    atomic_write(f"{cache_dir}/sources.json", json.dumps({"version": table_cache_version, "sources": sources}))
+
+
+# Default directory of the Parquet snapshots of the AOP Wiki tables, outside the tables directories
+TABLE_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "aop_wiki_tables")
+
+
+def table_cache_path(tables_dir, cache_dir=None):
+    """
+    Returns the directory of the Parquet snapshot of a tables directory. Each tables directory has
+        its own snapshot in cache_dir, named after a hash of its absolute path.
+    :param tables_dir (str): Directory containing the AOP Wiki tables
+    :param cache_dir (str): Directory holding the snapshots, TABLE_CACHE_DIR by default
+    :return(str): snapshot directory
+    """
+    if cache_dir is None:
+        cache_dir = TABLE_CACHE_DIR
+    return f"{cache_dir}/{hashlib.sha1(os.path.abspath(tables_dir).encode()).hexdigest()[:16]}"
+
+
+def import_tables(tables_dir="aop_wiki_tables", use_cache=True, cache_dir=None):
+    """
+    Import AOP Wiki tables from the aop_wiki_tables_directory. The normalized tables are cached
+        in a Parquet snapshot (in cache_dir, see table_cache_path()) so later runs can skip parsing the
+        CSV/TSV files. Caching needs pyarrow and is skipped if it is not installed. If the snapshot
+        cannot be written, e.g. because cache_dir is read-only, the tables are used without it.
+    :param tables_dir (str): Directory containing the AOP Wiki tables
+    :param use_cache (bool): Whether to load and write the snapshot
+    :param cache_dir (str): Directory holding the snapshots, TABLE_CACHE_DIR by default
+    :return(4 dataframes): returns dataframes of the EC_table, KE_table, KER_table and AOP_info
+    """
+    snapshot_dir = table_cache_path(tables_dir, cache_dir)
+    use_cache = use_cache and importlib.util.find_spec("pyarrow") is not None
+    if use_cache:
+        tables = load_table_cache(tables_dir, snapshot_dir)
+        if tables is not None:
+            return tables
+    tables = read_tables(tables_dir)
+    if use_cache:
+        try:
+            write_table_cache(tables_dir, snapshot_dir, tables)
+        except OSError as e:
+            print(f"Could not write the table snapshot to {snapshot_dir}, continuing without it: {e}")
+    return tables
+
+
+class AOPPartitions(dict):
+    """
+    Rows of an AOP Wiki table grouped by AOP number. The table is grouped once so that
+        each AOP's rows can be looked up without scanning the full table. AOPs that are
+        not in the table return an empty frame with the table's columns.
+    """
+
+    def __init__(self, table):
+        """
+        :param table(DF): EC, KE or KER table with an integer "AOP" column
+        """
+        super().__init__((AOP_num, rows) for AOP_num, rows in table.groupby("AOP", sort=False))
+        self.empty = table.iloc[0:0]
+
+    def __missing__(self, AOP_num):
+        return self.empty
+
+
+def partition_tables(AOP_EC_table, AOP_KE_table, AOP_KER_table):
+    """
+    Group the EC, KE and KER tables by AOP in a single pass each
+    :param AOP_EC_table(DF): Full EC table from AOP Wiki
+    :param AOP_KE_table(DF): Full KE table from AOP Wiki
+    :param AOP_KER_table(DF): Full KER table from AOP Wiki
+    :return(3 AOPPartitions): partitioned EC, KE and KER tables
+    """
+    return AOPPartitions(AOP_EC_table), AOPPartitions(AOP_KE_table), AOPPartitions(AOP_KER_table)
+
+
+def select_aop(AOP_num, table):
+    """
+    Returns the rows of a table for one AOP
+    :param AOP_num (int): AOP number to use for filtering
+    :param table (DF or AOPPartitions): Full table or table partitioned by AOP
+    :return(DF): rows of the table for the AOP
+    """
+    if isinstance(table, AOPPartitions):
+        return table[AOP_num]
+    return table[table["AOP"] == AOP_num]
+
+
+# AOP Wiki tables as used by build_aop(): the EC, KE and KER tables partitioned by AOP and the AOP info table
+AOPTables = collections.namedtuple("AOPTables", ["EC", "KE", "KER", "info"])
+
+
+def load_tables(tables_dir="aop_wiki_tables", use_cache=True, cache_dir=None):
+    """
+    Imports the AOP Wiki tables and partitions them by AOP, ready to build any number of AOPs from
+    :param tables_dir (str): Directory containing the AOP Wiki tables
+    :param use_cache (bool): Whether to use the Parquet snapshot of the tables, see import_tables()
+    :param cache_dir (str): Directory holding the snapshots, see import_tables()
+    :return(AOPTables): the partitioned tables
+    """
+    AOP_EC_table, AOP_KE_table, AOP_KER_table, AOP_info = import_tables(tables_dir, use_cache, cache_dir)
+    precompute_term_features(AOP_EC_table)
+    return AOPTables(*partition_tables(AOP_EC_table, AOP_KE_table, AOP_KER_table), AOP_info)
+
+
+def group_chunks_by_aop(chunks, filename):
+    """
+    Joins the chunks of a table sorted by AOP into the rows of each AOP. Only the rows of the
+        AOP being joined are held beyond the current chunk.
+    :param chunks (iterator): Normalized chunks of an EC, KE or KER table
+    :param filename (str): Name of the table file, for error messages
+    :return(iterator): (AOP_num, rows) for each AOP, in the order of the table
+    """
+    rows = None  # rows of the last AOP seen, which may continue in the next chunk
+    rows_AOP = None
+    for chunk in chunks:
+        AOPs = chunk["AOP"].to_numpy()
+        if len(AOPs) == 0:
+            continue
+        if (np.diff(AOPs) < 0).any() or (rows is not None and AOPs[0] < rows_AOP):
+            raise ValueError(f"{filename} must be sorted by AOP to be streamed")
+        bounds = [0, *(np.flatnonzero(np.diff(AOPs)) + 1), len(AOPs)]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            AOP_num = int(AOPs[start])
+            if rows is not None and AOP_num == rows_AOP:
+                rows = pd.concat([rows, chunk.iloc[start:end]])
+                continue
+            if rows is not None:
+                yield rows_AOP, rows
+            rows_AOP, rows = AOP_num, chunk.iloc[start:end]
+    if rows is not None:
+        yield rows_AOP, rows
+
+
+def read_table_chunks(tables_dir, name, chunksize):
+    """
+    Reads an EC, KE or KER table in chunks and normalizes each chunk, see normalize_table()
+    :param tables_dir (str): Directory containing the AOP Wiki tables
+    :param name (str): "EC", "KE" or "KER"
+    :param chunksize (int): Number of rows in each chunk
+    :return(iterator): normalized chunks of the table
+    """
+    filename, sep = table_files[name]
+    for chunk in pd.read_csv(f"{tables_dir}/{filename}", sep=sep, dtype=table_dtypes[name], chunksize=chunksize):
+        yield normalize_table(name, chunk)
+
+
+def stream_tables(tables_dir="aop_wiki_tables", chunksize=100000, hashes=None):
+    """
+    Reads the EC, KE and KER tables in chunks and yields the tables of one AOP at a time, so memory
+        use depends on the chunk size and the largest AOP rather than on the size of the tables.
+        The tables must be sorted by AOP number. AOPs are yielded in the order of the EC table;
+        KE and KER rows of AOPs without ECs are skipped, as in list_aops().
+    :param tables_dir (str): Directory containing the AOP Wiki tables
+    :param chunksize (int): Number of rows read from each table at a time
+    :param hashes (dict): If given, each AOP's input hash (see hash_tables()) is added to it
+    :return(iterator): AOPTables of each AOP, with the full AOP info table
+    """
+    AOP_info = pd.read_csv(f"{tables_dir}/AOP_info.csv")
+    AOP_info = AOP_info.set_index("ID")
+    streams = {}
+    empty = {}
+    for name in ["EC", "KE", "KER"]:
+        filename, sep = table_files[name]
+        path = f"{tables_dir}/{filename}"
+        empty[name] = normalize_table(name, pd.read_csv(path, sep=sep, dtype=table_dtypes[name], nrows=0))
+        streams[name] = group_chunks_by_aop(read_table_chunks(tables_dir, name, chunksize), filename)
+
+    current = {name: next(streams[name], None) for name in ["KE", "KER"]}
+    for AOP_num, AOP_EC_rows in streams["EC"]:
+        rows = {"EC": AOP_EC_rows}
+        for name in ["KE", "KER"]:
+            while current[name] is not None and current[name][0] < AOP_num:
+                current[name] = next(streams[name], None)
+            if current[name] is not None and current[name][0] == AOP_num:
+                rows[name] = current[name][1]
+            else:
+                rows[name] = empty[name]
+        if hashes is not None:
+            hashes.update(hash_tables(rows["EC"], rows["KE"], rows["KER"], AOP_info))
+        yield AOPTables(AOPPartitions(rows["EC"]), AOPPartitions(rows["KE"]), AOPPartitions(rows["KER"]), AOP_info)
+
+
+class Missing:
+    """
+    Type of MISSING, the value of the fields of an event component that are empty in the EC table
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        return "MISSING"
+
+    def __bool__(self):
+        return False
+
+    def __reduce__(self):
+        # keep MISSING a singleton when event components are sent to worker processes
+        return "MISSING"
+
+
+MISSING = Missing()
+
+
+class EventComponent(collections.namedtuple("EventComponent", [
+        "ke", "action", "object_id", "object_term", "object_source",
+        "process_phenotype_id", "process_phenotype_term", "process_phenotype_source"])):
+    """
+    One row of the EC table, holding only the columns used to build the ttl statements.
+        Field names are the normalized column names (see normalize_column_name()), and
+        empty values are MISSING.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_table(cls, table):
+        """
+        Creates an event component for each row of an EC table
+        :param table(DF): EC table, or the rows of one AOP
+        :return(list): event components in the order of the table
+        """
+        columns = get_columns(table, cls._fields)
+        columns = [[MISSING if pd.isna(value) else value for value in columns[field]] for field in cls._fields]
+        return [cls._make(values) for values in zip(*columns)]
+
+
 def create_EC_dict(AOP_num, AOP_EC_table):
     """
     Takes an AOP number and the EC table and returns a filtered EC table and
     a dictionary of all of the KEs in the AOP
     :param AOP_num (int): AOP number to use for filtering
-    :param AOP_EC_table: Full EC table from AOP Wiki
-    :return(DF, dictionary): dictionary of KE terms for the inputted AOP
-        AOP table filtered for the inputted AOP
+    :param AOP_EC_table: Full EC table from AOP Wiki, or the table partitioned by AOP
+    :return(DF, dictionary): dictionary of the event components (EventComponent) of each KE
+        in the inputted AOP, AOP table filtered for the inputted AOP
     """
-    AOP_EC_filtered = AOP_EC_table[AOP_EC_table["AOP"] == AOP_num].copy()
+    AOP_EC_filtered = select_aop(AOP_num, AOP_EC_table)
     EC_dict = {}
-    for index, row in AOP_EC_filtered.iterrows():
-        row_dict = dict(row)
-        if row["KE"] not in EC_dict.keys():
-            EC_dict[row["KE"]] = [row_dict]
-        else:
-            EC_dict[row["KE"]].append(row_dict)
+    for EC in EventComponent.from_table(AOP_EC_filtered):
+        EC_dict.setdefault(EC.ke, []).append(EC)
     return EC_dict, AOP_EC_filtered
 
 
@@ -200,11 +747,11 @@ def create_AO_dict(AOP_num, AOP_KE_table):
         Takes an AOP number and the KE table and returns
         a dictionary of all of the Adverse Outcomes (AOs) in the AOP
         :param AOP_num (int): AOP number to use for filtering
-        :param AOP_EC_table: Full KE table from AOP Wiki
+        :param AOP_EC_table: Full KE table from AOP Wiki, or the table partitioned by AOP
         :return(DF, dictionary): dictionary of KE terms for the inputted AOP
             AOP table filtered for the inputted AOP
     """
-    AOP_KE_filtered = AOP_KE_table[AOP_KE_table["AOP"] == AOP_num].copy()
+    AOP_KE_filtered = select_aop(AOP_num, AOP_KE_table).copy()
     AO_dict = {}
     for index, row in AOP_KE_filtered.iterrows():
         AO_dict[row.KE] = re.sub(r",", ";", row["Adverse Outcome"])
@@ -216,39 +763,109 @@ def create_ke_dicts(AOP_num, AOP_KER_table):
     Tales an AOP number and the Key Event Relationships and returns a list
         of the KE pairs (the KEs adjacent to each other in the AOP), a list
         of the order the KEs are in the AOP, a dictionary to look up which
-        KE follows the KE of interest.
+        KEs follow the KE of interest. The adjacent KERs are treated as a graph,
+        so AOPs that branch or merge keep every edge. KEs are ordered
+        topologically (KEs on a cycle are added after the others), with ties
+        broken by the order the KEs first appear in the table.
     :param AOP_num: AOP number to be processed
     :param AOP_KER_table: Key Event Relationship table. Dataframe containing
-        information on the order of KEs in an AOP
+        information on the order of KEs in an AOP, or the table partitioned by AOP
     :return (list of tuples, dict, list of integers): a list of the KE pairs
-        (the KEs adjacent to each other in the AOP), a list of the order the
-        KEs are in the AOP, a dictionary to look up which KE follows the
-        KE of interest.
+        (the KEs adjacent to each other in the AOP), a dictionary of the list of
+        KEs that follow each KE, and a list of the order the KEs are in the AOP.
     """
-    AOP_KER_filtered = AOP_KER_table[AOP_KER_table["AOP"] == AOP_num].reset_index().copy()
-    KE_pairs = []
+    AOP_KER_filtered = select_aop(AOP_num, AOP_KER_table)
+    adjacent = AOP_KER_filtered[AOP_KER_filtered["adjacent"] == "adjacent"]
+    KE_pairs = list(zip(adjacent["Event1"].tolist(), adjacent["Event2"].tolist()))
+
+    # Adjacency list of the KER graph
     KE_order_dict = {}
+    for KE1, KE2 in KE_pairs:
+        KE_order_dict.setdefault(KE1, [])
+        KE_order_dict.setdefault(KE2, [])
+        if KE2 not in KE_order_dict[KE1]:
+            KE_order_dict[KE1].append(KE2)
+
+    # Order the KEs topologically (Kahn's algorithm)
+    in_degree = {KE: 0 for KE in KE_order_dict}
+    for next_KEs in KE_order_dict.values():
+        for next_KE in next_KEs:
+            in_degree[next_KE] += 1
+    ready = collections.deque(KE for KE, degree in in_degree.items() if degree == 0)
     KE_order = []
-    for index, row in AOP_KER_filtered.iterrows():
-        if row.adjacent != "adjacent":
-            continue
-        if index == 0:
-            KE_order.append(row.Event1)
-            KE_order.append(row.Event2)
-        else:
-            KE_order.append(row.Event2)
-
-        KE_order_dict[row.Event1] = row.Event2
-        KE_pairs += [(row.Event1, row.Event2)]
+    while ready:
+        KE = ready.popleft()
+        KE_order.append(KE)
+        for next_KE in KE_order_dict[KE]:
+            in_degree[next_KE] -= 1
+            if in_degree[next_KE] == 0:
+                ready.append(next_KE)
+    if len(KE_order) < len(KE_order_dict):
+        ordered = set(KE_order)
+        KE_order += [KE for KE in KE_order_dict if KE not in ordered]
     return KE_pairs, KE_order_dict, KE_order
 
 
-def create_ttl_dicts(AOP_EC_filtered):
+def get_successor_ECs(EC_dict, KE_order_dict):
+    """
+    Returns the event components of the KEs that follow each KE
+    :param EC_dict (dict): Event components (EventComponent) of each KE
+    :param KE_order_dict (dict): Dict of the list of KEs that follow each KE
+    :return(dict): list of the event components of the following KEs, by KE
+    """
+    return {KE: [EC for next_KE in next_KEs for EC in EC_dict.get(next_KE, [])]
+            for KE, next_KEs in KE_order_dict.items()}
+
+
+def get_link_id(EC):
+    """
+    Returns the ID of the term an event component is linked to the next KE with: its
+        process/phenotype, or its object if it has no process/phenotype
+    :param EC (EventComponent): Event component
+    :return(str): term ID
+    """
+    if EC.process_phenotype_id is not MISSING:
+        return EC.process_phenotype_id
+    return EC.object_id
+
+
+@functools.lru_cache(maxsize=None)
+def normalize_column_name(column):
+    """
+    Lower-cases a column name and replaces whitespace and slashes with underscores
+        (e.g. "Process/Phenotype ID" -> "process_phenotype_id")
+    :param column (str): Column name
+    :return(str): normalized column name
+    """
+    return re.sub(r"[\s\/]", "_", column.lower())
+
+
+def get_columns(table, column_names):
+    """
+    Takes a table and a list of normalized column names and returns the columns as lists
+    :param table(DF): Table to take the columns from
+    :param column_names (list): Normalized names of the columns to return
+    :return(dict): lists of column values by normalized column name
+    """
+    columns = {normalize_column_name(c): c for c in table.columns}
+    return {c: table[columns[c]].tolist() for c in column_names}
+
+
+# A pair of terms classified by create_ttl_dicts(): an EC's object and process/phenotype (ke1 == ke2),
+#   or an EC and an EC of a following KE, with the suggested relationship IDs between them
+TermPair = collections.namedtuple("TermPair", ["ke1", "ke2", "action1", "source1", "id1", "term1", "ECtype1",
+                                               "action2", "source2", "id2", "term2", "ECtype2",
+                                               "relationship_ids"])
+
+
+def create_ttl_dicts(AOP_EC_filtered, KE_order_dict, term_pairs=None):
     """
     Takes the EC table filtered for the AOP being processed and
         returns 4 dicts of all of the class, individual,
         relationship, and object statements for the ttl file
     :param AOP_EC_filtered(DF): EC table filtered for the AOP being processed
+    :param KE_order_dict (dict): Dict of the list of KEs that follow each KE
+    :param term_pairs (list): If given, a TermPair is added to it for every pair of terms classified
     :return(4 dicts):  dictionaries containing statements for
         the ttl file.
     """
@@ -259,278 +876,1009 @@ def create_ttl_dicts(AOP_EC_filtered):
     relationships = {}
     object_statements = {}
     aop_relationships = []
-    # Cycle through rows and create classes and individuals
-    for index, row in AOP_EC_filtered.iterrows():
-        row = row.rename(lambda x: re.sub(r"[\s\/]", "_", x.lower()))
-        # if object_id is not already in classes.keys() add object_id
-
-        # if row.object_id not in classes.keys() and row.object_id is not NA
-        if not pd.isna(row.object_id):
-            class_statement, individuals_statement = process_term(row.object_id, row.object_term, row.object_source)
-            classes[row.object_id] = class_statement
-            individuals[row.object_id] = individuals_statement
-        # if process_phenotype_id is not already in individuals.keys() add process_phenotype_id
-
-        # if row.process_phenotype_id not in individuals.keys() and not pd.isna(row.process_phenotype_id):
-        if not pd.isna(row.process_phenotype_id):
-            class_statement, individuals_statement = process_term(row.process_phenotype_id, row.process_phenotype_term,
-                                                                  row.process_phenotype_source)
-            classes[row.process_phenotype_id] = class_statement
-            individuals[row.process_phenotype_id] = individuals_statement
-
-        row_relationship_statement, rel_id_list = get_relationship_statement(row.action, row.object_term,
-                                                                             row.object_source, "Object", "",
-                                                                             row.process_phenotype_term,
-                                                                             row.process_phenotype_source,
-                                                                             "Process/Phenotype")
-        aop_relationships += rel_id_list
-        object_statements = get_object_statement(rel_id_list, object_statements)
-        relationships[(row.object_id, row.process_phenotype_id)] = row_relationship_statement
-        if row.ke in KE_order_dict.keys():
-            try:
-                next_KE_num = KE_order_dict[row.ke]
-                EC_dict[next_KE_num]
-            except:
-                continue
-
-            for next_KE in EC_dict[next_KE_num]:
-                if row.process_phenotype_id is not np.nan and next_KE["Process/Phenotype ID"] is not np.nan:
-                    row_relationship_statement, rel_id_list = get_relationship_statement(row.action,
-                                                                                         row.process_phenotype_term,
-                                                                                         row.process_phenotype_source,
-                                                                                         "Process/Phenotype",
-                                                                                         "",
-                                                                                         next_KE[
-                                                                                             "Process/Phenotype Term"],
-                                                                                         next_KE[
-                                                                                             "Process/Phenotype Source"],
-                                                                                         "Process/Phenotype")
-                    relationships[
-                        (row.process_phenotype_id, next_KE["Process/Phenotype ID"])] = row_relationship_statement
-                    object_statements = get_object_statement(rel_id_list, object_statements)
-                elif row.process_phenotype_id is not np.nan and next_KE["Process/Phenotype ID"] is np.nan:
-                    row_relationship_statement, rel_id_list = get_relationship_statement(row.action,
-                                                                                         row.process_phenotype_term,
-                                                                                         row.process_phenotype_source,
-                                                                                         "Process/Phenotype",
-                                                                                         "",
-                                                                                         next_KE["Object Term"],
-                                                                                         next_KE["Object Source"],
-                                                                                         "Object")
-                    relationships[(row.process_phenotype_id, next_KE["Object ID"])] = row_relationship_statement
-                    object_statements = get_object_statement(rel_id_list, object_statements)
-                elif row.process_phenotype_id is np.nan and next_KE["Process/Phenotype ID"] is not np.nan:
-                    row_relationship_statement, rel_id_list = get_relationship_statement(row.action,
-                                                                                         row.object_term,
-                                                                                         row.object_source,
-                                                                                         "Object",
-                                                                                         "",
-                                                                                         next_KE[
-                                                                                             "Process/Phenotype Term"],
-                                                                                         next_KE[
-                                                                                             "Process/Phenotype Source"],
-                                                                                         "Process/Phenotype")
-                    relationships[(row.object_id, next_KE["Process/Phenotype ID"])] = row_relationship_statement
-                    object_statements = get_object_statement(rel_id_list, object_statements)
-                elif row.process_phenotype_id is np.nan and next_KE["Process/Phenotype ID"] is np.nan:
-                    row_relationship_statement, rel_id_list = get_relationship_statement(row.action,
-                                                                                         row.object_term,
-                                                                                         row.object_source,
-                                                                                         "Object",
-                                                                                         "",
-                                                                                         next_KE["Object Term"],
-                                                                                         next_KE["Object Source"],
-                                                                                         "Object")
-                    relationships[(row.object_id, next_KE["Object ID"])] = row_relationship_statement
-                    object_statements = get_object_statement(rel_id_list, object_statements)
+    # Work on the columns as lists instead of creating a Series for every row
+    ECs = get_columns(AOP_EC_filtered, ["ke", "action", "object_id", "object_term", "object_source",
+                                        "process_phenotype_id", "process_phenotype_term",
+                                        "process_phenotype_source"])
+    KEs = ECs["ke"]
+    actions = ECs["action"]
+    object_ids = ECs["object_id"]
+    object_terms = ECs["object_term"]
+    object_sources = ECs["object_source"]
+    process_ids = ECs["process_phenotype_id"]
+    process_terms = ECs["process_phenotype_term"]
+    process_sources = ECs["process_phenotype_source"]
+    has_object = [not pd.isna(i) for i in object_ids]
+    has_process = [not pd.isna(i) for i in process_ids]
+
+    # Collect the distinct term IDs in order of appearance, keeping the last name and source
+    #   seen for each ID, then create the class and individual statements once per ID
+    terms = {}
+    for i in range(len(KEs)):
+        if has_object[i]:
+            terms[object_ids[i]] = (object_terms[i], object_sources[i])
+        if has_process[i]:
+            terms[process_ids[i]] = (process_terms[i], process_sources[i])
+    for term_id, (name, source) in terms.items():
+        classes[term_id], individuals[term_id] = process_term(term_id, name, source)
+
+    # Each EC links its object to its process/phenotype, and links to the ECs of the next KE
+    #   through its process/phenotype, or its object if it has no process/phenotype
+    links = [(process_ids[i], process_terms[i], process_sources[i], "Process/Phenotype") if has_process[i]
+             else (object_ids[i], object_terms[i], object_sources[i], "Object") for i in range(len(KEs))]
+    KE_rows = {}
+    for i, KE in enumerate(KEs):
+        KE_rows.setdefault(KE, []).append(i)
+
+    row_pairs = []
+    for i in range(len(KEs)):
+        pairs = [((object_ids[i], process_ids[i]), (KEs[i], KEs[i]),
+                  (actions[i], object_terms[i], object_sources[i], "Object", "",
+                   process_terms[i], process_sources[i], "Process/Phenotype"))]
+        link_id, link_term, link_source, link_type = links[i]
+        for next_KE in KE_order_dict.get(KEs[i], []):
+            for j in KE_rows.get(next_KE, []):
+                next_id, next_term, next_source, next_type = links[j]
+                pairs.append(((link_id, next_id), (KEs[i], next_KE),
+                              (actions[i], link_term, link_source, link_type, "", next_term, next_source, next_type)))
+        row_pairs.append(pairs)
+
+    # Check which terms contain which once for the whole AOP, so classifying each pair is a lookup
+    contained = containment_index((args[1], args[5]) for pairs in row_pairs for key, KE_pair, args in pairs)
+    for pairs in row_pairs:
+        for n, (key, KE_pair, args) in enumerate(pairs):
+            row_relationship_statement, rel_id_list = get_relationship_statement(
+                *args, contains=(args[1], args[5]) in contained)
+            if term_pairs is not None:
+                action1, term1, source1, ECtype1, action2, term2, source2, ECtype2 = args
+                term_pairs.append(TermPair(*KE_pair, action1, source1, key[0], term1, ECtype1,
+                                           action2, source2, key[1], term2, ECtype2, tuple(rel_id_list)))
+            if n == 0:
+                aop_relationships += rel_id_list
+            object_statements = get_object_statement(rel_id_list, object_statements)
+            relationships[key] = row_relationship_statement
     return classes, individuals, relationships, object_statements, aop_relationships
 
 
-def write_ttl(outfile, EC_dict, KE_order, KE_order_dict, classes, individuals, relationships,
-              object_statements, IRI, title, status):
+# Prefix and base directives at the top of every ttl file
+ttl_prefixes = ["@prefix owl: <http://www.w3.org/2002/07/owl#> .",
+                "@prefix rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#> .",
+                "@prefix xml: <http://www.w3.org/XML/1998/namespace> .",
+                "@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .",
+                "@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .",
+                "@prefix : <http://www.co-ode.org/ontologies/ont.owl#> .",
+                "@base <http://www.w3.org/2002/07/owl#> ."]
+
+
+def render_header(IRI, title, status):
+    '''
+    Returns the predetermined header of a ttl file
+    :param IRI: IRI statement to be added to header
+    :param title: Title statement to be added to header
+    :param status: Model state statement to be added to header
+    :return(str): ttl header
+    '''
+    prefixes = "\n    ".join(ttl_prefixes)
+    header = f'''{prefixes}\n\n    {IRI}\n{title}\n{status}\n        '''
+    return header
+
+
+def render_section_header(section):
+    '''
+    Returns the predetermined header of a section (Classes, Individuals, Object Statements) of a ttl file
+    :param section (str): Name of the section
+    :return(str): section header
+    '''
+    return ("\n\n#################################################################"
+            f"\n#   {section}"
+            "\n#################################################################\n\n")
+
+
+def render_individuals(EC_dict, KE_order, KE_order_dict, individuals, relationships):
     '''
-    Write ttl file using statements from the dictionaries created by create_ttl_dicts().
-    :param outfile( (str): filt to write to
-    :param EC_dict (dict): Dictionaries of event componemts
+    Returns the individual and relationship statements of the KEs in order (using KE_order)
+    :param EC_dict (dict): Event components (EventComponent) of each KE
     :param KE_order (list): List of KEs in order of occurrence in the AOP
-    :param KE_order_dict (dict): Dict of KEs that you can use to get the next KE in the sequence
-    :param classes: Dict of class statements
+    :param KE_order_dict (dict): Dict of the list of KEs that follow each KE
     :param individuals: Dict of individual statements
     :param relationships: Dict of relationship statements
-    :param object_statements: Dict of object statements
-    :param IRI: IRI statement to be added to header
-    :return: None, a .ttl file is written instead
-    '''
-
-    error_c = 0
-    missing_components = []
-    # write predetermined header
-    header = \
-    f'''@prefix owl: <http://www.w3.org/2002/07/owl#> .
-    @prefix rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#> .
-    @prefix xml: <http://www.w3.org/XML/1998/namespace> .
-    @prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
-    @prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
-    @prefix : <http://www.co-ode.org/ontologies/ont.owl#> .
-    @base <http://www.w3.org/2002/07/owl#> .
-
-    {IRI}\n{title}\n{status}
-        '''
-    with open(outfile, "w+") as f:
-        f.write(header)
-
-    # Write pre-determined header for classes
-    with open(outfile, "a") as f:
-        f.write("\n\n#################################################################")
-        f.write("\n#   Classes")
-        f.write("\n#################################################################\n\n")
-
-    # Loop through class statements and write them to the output file
-    for c, s in classes.items():
-        with open(outfile, "a") as f:
-            f.write(s)
-
-    # Write pre-determined header for individuals
-    with open(outfile, "a") as f:
-        f.write("\n\n#################################################################")
-        f.write("\n#   Individuals")
-        f.write("\n#################################################################\n\n")
-
-    # Loop through KEs in order (using KE_order) and write an individuals statement for each KE
-    with open(outfile, "a") as f:
-        for KE_id in KE_order:
-            # print(KE_id)
-            try:
-                EC_dict[KE_id]
-            except:
-                error_c += 1
-                missing_components.append(KE_id)
-                EC_dict[KE_id] = []
-
-            for KE in EC_dict[KE_id]:
-                if KE_id in KE_order_dict.keys():
-                    next_KE_id = KE_order_dict[KE_id]
-                    try:
-                        next_KEs = EC_dict[next_KE_id]
-
-                    except:
-                        error_c += 1
-                        missing_components.append(next_KE_id)
-                        next_KEs = []
-                else:
-                    next_KEs = []
-
-                if KE["Object ID"] is not np.nan:  # if there is an object, write an instance of that object
-                    f.write(individuals[KE['Object ID']])
-
-                if KE["Object ID"] is not np.nan and KE[
-                    "Process/Phenotype ID"] is not np.nan:  # if there are both and object and process, write the relationshp
-                    f.write(" ;\n" + relationships[(KE['Object ID'], KE["Process/Phenotype ID"])])
-                    f.write(" .\n\n")
-
-                if KE["Process/Phenotype ID"] is not np.nan:  # if there is a process, write an instance of that process
-                    f.write(individuals[KE['Process/Phenotype ID']])
-
-                # if KE_id in KE_order_dict.keys():  # if there is a next KE in the order_dict
-                for next_KE in next_KEs:  # go through the next KEs
-                    try:
-                        if KE["Process/Phenotype ID"] is not np.nan and next_KE["Process/Phenotype ID"] is not np.nan:
-                            # print(" ;\n" + relationships[KE["Process/Phenotype ID"], next_KE["Process/Phenotype ID"]])
-                            f.write(" ;\n" + relationships[KE["Process/Phenotype ID"], next_KE["Process/Phenotype ID"]])
-                        elif KE["Process/Phenotype ID"] is not np.nan and next_KE["Process/Phenotype ID"] is np.nan:
-                            f.write(" ;\n" + relationships[KE["Process/Phenotype ID"], next_KE["Object ID"]])
-                        elif KE["Process/Phenotype ID"] is np.nan and next_KE["Process/Phenotype ID"] is not np.nan:
-                            f.write(" ;\n" + relationships[KE["Object ID"], next_KE["Process/Phenotype ID"]])
-                        elif KE["Process/Phenotype ID"] is np.nan and next_KE["Process/Phenotype ID"] is np.nan:
-                            f.write(" ;\n" + relationships[KE["Object ID"], next_KE["Object ID"]])
-                    except:
-                        continue
-                f.write(" .\n\n")
-
-    # Write predetermined object header
-    with open(outfile, "a") as f:
-        f.write("\n\n#################################################################")
-        f.write("\n#   Object Statements")
-        f.write("\n#################################################################\n\n")
-
-    # Loop through class statements and write them to the output file
-    for o, s in object_statements.items():
-        with open(outfile, "a") as f:
-            f.write(s)
-    if error_c > 0:
-        aop_summary_txt = f"{AOP_num}: missing KE(s){list(set(missing_components))}\n"
-    else:
-        aop_summary_txt = f"{AOP_num}: complete\n"
-    with open(log, 'a') as logf:
-        logf.write(aop_summary_txt)
-    return error_c
-
-datestamp = "082423"
-AOP_EC_table, AOP_KE_table, AOP_KER_table, AOP_info = import_tables()
-
-AOP_nums = list(set(AOP_EC_table["AOP"]))
-# AOP_nums = [100, 101, 102, 103, 104, 105]
-# AOP_nums = [200]
-# AOP_nums = [23]
-# AOP_nums = [102]
-# AOP_nums = [429, 411, 412]
-c_completed = []
-c_missing = []
-log = f"output/{datestamp}/log.txt"
-open(log, "w+").close()
-
-all_relationships = [] # list of relationships from all AOPs
-
-# Loop through the AOPs in AOP_nums and try to write a ttl file for each AOP. Keep a list of
-#   successful and failed AOPs, Print the error message when an AOP fails.
-for AOP_num in AOP_nums:
-    # print(f"AOP {AOP_num}")
-    outfile = f"output/{datestamp}/AOP_{AOP_num}.ttl"
+    :return(str, int, list): individuals section of the ttl file, number of missing KEs and the missing KEs
+    '''
+    successor_ECs = get_successor_ECs(EC_dict, KE_order_dict)
+    missing_components = [KE_id for KE_id in KE_order if KE_id not in EC_dict]
+    error_c = len(missing_components)
+    parts = []
+    for KE_id in KE_order:
+        next_KEs = successor_ECs.get(KE_id, [])
+        for KE in EC_dict.get(KE_id, []):
+            if KE.object_id is not MISSING:  # if there is an object, write an instance of that object
+                parts.append(individuals[KE.object_id])
+
+            if KE.object_id is not MISSING and \
+                    KE.process_phenotype_id is not MISSING:  # if there are both and object and process, write the relationshp
+                parts.append(" ;\n" + relationships[(KE.object_id, KE.process_phenotype_id)])
+                parts.append(" .\n\n")
+
+            if KE.process_phenotype_id is not MISSING:  # if there is a process, write an instance of that process
+                parts.append(individuals[KE.process_phenotype_id])
+
+            # write the relationships to the ECs of the next KEs
+            link_id = get_link_id(KE)
+            for next_KE in next_KEs:
+                relationship_statement = relationships.get((link_id, get_link_id(next_KE)))
+                if relationship_statement is not None:
+                    parts.append(" ;\n" + relationship_statement)
+            parts.append(" .\n\n")
+    return "".join(parts), error_c, missing_components
+
+
+def render_ttl(classes, individuals_txt, object_statements, IRI, title, status):
+    '''
+    Builds the ttl document from the dictionaries created by create_ttl_dicts() and the individuals
+        section rendered by render_individuals().
+    :return(str): ttl document
+    '''
+    parts = [render_header(IRI, title, status), render_section_header("Classes")]
+    parts += classes.values()
+    parts += [render_section_header("Individuals"), individuals_txt, render_section_header("Object Statements")]
+    parts += object_statements.values()
+    return "".join(parts)
+
+
+def atomic_write(outfile, text):
+    '''
+    Writes text to outfile through a temporary file that is renamed over outfile once it has
+        been completely written, so a crashed run never leaves a partially written file
+    :param outfile (str): File to write
+    :param text (str): Text to write
+    '''
+    tmpfile = f"{outfile}.{os.getpid()}.tmp"
     try:
-        # download DFs and create dicts
-        EC_dict, AOP_EC_filtered = create_EC_dict(AOP_num, AOP_EC_table)
-        AO_dict = create_AO_dict(AOP_num, AOP_KE_table)
-        KE_pairs, KE_order_dict, KE_order = create_ke_dicts(AOP_num, AOP_KER_table)
-        classes, instances, relationships, object_statements, aop_relationships = create_ttl_dicts(AOP_EC_filtered)
-        all_relationships += aop_relationships
-
-        # Write ttl file
-        # AO = AOP_KE_table["Adverse Outcome"][AOP_num]
-        # title = AOP_info[AOP_num]["Title"]
-
-        if AOP_num in AOP_info["Title"]:
-            title = AOP_info["Title"][AOP_num]
+        with open(tmpfile, "w") as f:
+            f.write(text)
+        os.replace(tmpfile, outfile)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+
+class CombinedTTLWriter:
+    '''
+    Streams the ttl documents of many AOPs into one TriG file, gzip compressed if the path ends in .gz.
+        Prefixes are written once at the top, each AOP's model statements (IRI, title, status) and
+        individuals are written in a named graph with the AOP's model IRI, so edges of different AOPs
+        between the same individuals stay apart, and the class and object property statements shared
+        between AOPs are written once at the end, in the default graph. The file is written to a
+        temporary file that is renamed to path when the writer is closed.
+    '''
+
+    def __init__(self, path):
+        '''
+        :param path (str): Combined ttl file to write
+        '''
+        self.path = path
+        self.tmpfile = f"{path}.{os.getpid()}.tmp"
+        self.f = gzip.open(self.tmpfile, "wt") if path.endswith(".gz") else open(self.tmpfile, "w")
+        self.f.write("\n".join(ttl_prefixes) + "\n")
+        self.classes = {}
+        self.object_statements = {}
+
+    def add_aop(self, graph):
+        '''
+        Adds an AOP's statements to the combined file
+        :param graph (TTLGraph): The AOP's statements, see TTLDocument.graph()
+        '''
+        self.f.write(render_section_header(f"AOP {graph.AOP_num}"))
+        self.f.write(f"<https://noctua.apps.renci.org/model/AOP_{graph.AOP_num}> {{\n")
+        self.f.write("\n".join(graph.model_statements) + "\n\n")
+        self.f.write(graph.individuals)
+        self.f.write("}\n")
+        self.classes.update(dict.fromkeys(graph.classes))
+        self.object_statements.update(dict.fromkeys(graph.object_statements))
+
+    def close(self):
+        '''
+        Writes the shared class and object property statements and moves the file into place
+        '''
+        self.f.write(render_section_header("Classes"))
+        self.f.writelines(self.classes)
+        self.f.write(render_section_header("Object Statements"))
+        self.f.writelines(self.object_statements)
+        self.f.close()
+        os.replace(self.tmpfile, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
         else:
-            title = f"AOP {AOP_num}"
-        print(AOP_num, title)
-        IRI = f"<https://noctua.apps.renci.org/model/AOP_{AOP_num}> a owl:Ontology ."
-        title = f'<https://noctua.apps.renci.org/model/AOP_{AOP_num}> <http://purl.org/dc/elements/1.1/title> "{title}"^^xsd:string .'
-        status = f'<https://noctua.apps.renci.org/model/{AOP_num}> <http://geneontology.org/lego/modelstate> "review"^^xsd:string .'
-        error_c = write_ttl(outfile, EC_dict, KE_order, KE_order_dict, classes, instances, relationships,
-                            object_statements, IRI, title, status)
+            self.f.close()
+            os.remove(self.tmpfile)
+
+
+# The statements of one AOP that go into its named graph or the shared default graph of the combined file
+TTLGraph = collections.namedtuple("TTLGraph", ["AOP_num", "model_statements", "individuals", "classes",
+                                               "object_statements"])
+
+
+@dataclasses.dataclass
+class TTLDocument:
+    '''
+    The ttl document of one AOP, with the statement dicts it was rendered from
+    '''
+    AOP_num: int
+    title: str
+    ttl: str  # the rendered document
+    classes: dict
+    individuals: dict
+    relationships: dict
+    object_statements: dict
+    aop_relationships: list  # relationship IDs suggested between the objects and processes/phenotypes
+    error_c: int  # number of missing KEs
+    missing_components: list
+    term_pairs: list = dataclasses.field(default_factory=list)  # TermPair of each classified pair of terms
+    model_statements: tuple = ()  # IRI, title and status statements of the AOP's model
+    individuals_txt: str = ""  # the rendered individuals section
+
+    @property
+    def log(self):
+        '''
+        :return(str): the AOP's log entry
+        '''
+        if self.error_c > 0:
+            return f"{self.AOP_num}: missing KE(s){list(set(self.missing_components))}\n"
+        return f"{self.AOP_num}: complete\n"
+
+    def write(self, outfile):
+        '''
+        Writes the document to outfile, see atomic_write()
+        :param outfile (str): ttl file to write
+        '''
+        atomic_write(outfile, self.ttl)
+
+    def graph(self):
+        '''
+        :return(TTLGraph): the statements of the document for CombinedTTLWriter
+        '''
+        return TTLGraph(self.AOP_num, self.model_statements, self.individuals_txt, tuple(self.classes.values()),
+                        tuple(self.object_statements.values()))
 
 
+def get_title(AOP_num, AOP_info):
+    """
+    Returns the title of an AOP
+    :param AOP_num (int): AOP number
+    :param AOP_info(DF): AOP info table indexed by AOP ID
+    :return(str): the AOP's title, or "AOP <AOP_num>" if it has none
+    """
+    if AOP_num in AOP_info["Title"]:
+        return AOP_info["Title"][AOP_num]
+    return f"AOP {AOP_num}"
+
+
+def record_stage(metrics, stage, start, **counters):
+    """
+    Records the wall time since start and the counters of a pipeline stage
+    :param metrics (dict): Metrics of each stage by stage name, nothing is recorded if None
+    :param stage (str): Name of the stage
+    :param start (float): time.perf_counter() at the start of the stage
+    :param counters: Counts to record for the stage, e.g. rows or statements
+    :return(float): time.perf_counter() at the end of the stage, the start of the next stage
+    """
+    end = time.perf_counter()
+    if metrics is not None:
+        metrics[stage] = {"time": end - start, **counters}
+    return end
+
+
+def build_aop(AOP_num, tables, metrics=None):
+    """
+    Builds the statements for one AOP and renders its ttl document. The AOP is built from the
+        tables passed in only, but rendering shares the process-wide term caches (term_registry,
+        term_features and the relationship_predicates() and quote_term() caches). These only hold
+        statements derived from the terms, so they never change a document, and long-running callers
+        can empty the unbounded ones with clear_term_caches().
+    :param AOP_num (int): AOP to build
+    :param tables (AOPTables): AOP Wiki tables, see load_tables()
+    :param metrics (dict): If given, the wall time and counters of each stage are added to it, see record_stage()
+    :return(TTLDocument): the AOP's ttl document
+    """
+    # download DFs and create dicts
+    start = time.perf_counter()
+    EC_dict, AOP_EC_filtered = create_EC_dict(AOP_num, tables.EC)
+    start = record_stage(metrics, "create_EC_dict", start, rows=len(AOP_EC_filtered), KEs=len(EC_dict))
+    AO_dict = create_AO_dict(AOP_num, tables.KE)
+    start = record_stage(metrics, "create_AO_dict", start, rows=len(AO_dict))
+    KE_pairs, KE_order_dict, KE_order = create_ke_dicts(AOP_num, tables.KER)
+    start = record_stage(metrics, "create_ke_dicts", start, rows=len(KE_pairs), KEs=len(KE_order))
+    cache_before = relationship_cache_info()
+    term_pairs = []
+    classes, instances, relationships, object_statements, aop_relationships = create_ttl_dicts(AOP_EC_filtered,
+                                                                                               KE_order_dict,
+                                                                                               term_pairs)
+    cache_after = relationship_cache_info()
+    start = record_stage(metrics, "create_ttl_dicts", start, rows=len(AOP_EC_filtered),
+                         statements=len(classes) + len(instances) + len(relationships) + len(object_statements),
+                         relationship_cache_hits=cache_after.hits - cache_before.hits,
+                         relationship_cache_misses=cache_after.misses - cache_before.misses)
+
+    # Render ttl document
+    title = get_title(AOP_num, tables.info)
+    IRI = f"<https://noctua.apps.renci.org/model/AOP_{AOP_num}> a owl:Ontology ."
+    title_statement = f'<https://noctua.apps.renci.org/model/AOP_{AOP_num}> <http://purl.org/dc/elements/1.1/title> "{title}"^^xsd:string .'
+    status = f'<https://noctua.apps.renci.org/model/{AOP_num}> <http://geneontology.org/lego/modelstate> "review"^^xsd:string .'
+    individuals_txt, error_c, missing_components = render_individuals(EC_dict, KE_order, KE_order_dict, instances,
+                                                                      relationships)
+    ttl = render_ttl(classes, individuals_txt, object_statements, IRI, title_statement, status)
+    record_stage(metrics, "render_ttl", start, bytes=len(ttl), missing_KEs=error_c)
+    return TTLDocument(AOP_num, title, ttl, classes, instances, relationships, object_statements,
+                       aop_relationships, error_c, missing_components, term_pairs,
+                       (IRI, title_statement, status), individuals_txt)
+
+
+def list_aops(tables):
+    """
+    :param tables (AOPTables): AOP Wiki tables, see load_tables()
+    :return(list): the numbers of the AOPs in the EC table, sorted
+    """
+    return sorted(tables.EC)
+
+
+def build_all(tables, AOP_nums=None):
+    """
+    Builds the ttl documents of many AOPs lazily, one AOP per iteration. Exceptions raised
+        while building an AOP are passed on to the caller.
+    :param tables (AOPTables): AOP Wiki tables, see load_tables()
+    :param AOP_nums (list): AOPs to build, all AOPs in the EC table by default
+    :return(iterator): TTLDocument of each AOP
+    """
+    if AOP_nums is None:
+        AOP_nums = list_aops(tables)
+    for AOP_num in AOP_nums:
+        yield build_aop(AOP_num, tables)
+
+
+def write_aop(AOP_num, tables, outfile, collect_metrics=False, keep_graph=False):
+    """
+    Builds one AOP and writes its ttl file
+    :param AOP_num (int): AOP to write
+    :param tables (AOPTables): AOP Wiki tables, see load_tables()
+    :param outfile (str): ttl file to write
+    :param collect_metrics (bool): Whether to record the wall time and counters of each stage
+    :param keep_graph (bool): Whether to return the AOP's statements for the combined file
+    :return(int, str, list, dict, list, TTLGraph): number of missing KEs (None if the AOP could not be written),
+        the AOP's log entry, the relationships used in the AOP, the metrics of each stage
+        (None if collect_metrics is False), the AOP's term pairs (see create_ttl_dicts()), and the AOP's
+        statements (None if keep_graph is False or the AOP could not be written)
+    """
+    metrics = {} if collect_metrics else None
+    try:
+        document = build_aop(AOP_num, tables, metrics)
+        start = time.perf_counter()
+        document.write(outfile)
+        record_stage(metrics, "write_ttl", start, bytes=len(document.ttl))
     except Exception as e:
-        # c_missing.append(AOP_num)
-        with open(log, 'a') as logf:
-            txt = traceback.format_exc()
+        txt = traceback.format_exc()
 
-            #  indent error message
-            txt = re.sub(r"\n(\s*)?(?=[^$])", "\n\t", txt)
-            txt = re.sub(r"^", "\t", txt)
+        #  indent error message
+        txt = re.sub(r"\n(\s*)?(?=[^$])", "\n\t", txt)
+        txt = re.sub(r"^", "\t", txt)
+        return None, f"{AOP_num} is missing elements\n{txt}", [], metrics, [], None
+    return (document.error_c, document.log, document.aop_relationships, metrics, document.term_pairs,
+            document.graph() if keep_graph else None)
 
-            logf.write(f"{AOP_num} is missing elements\n{txt}")
 
-            continue
-    if error_c > 0:
-        c_missing.append(AOP_num)
+# Tables shared with the worker processes, set once per worker by init_worker()
+worker_tables = None
+
+
+def init_worker(tables):
+    """
+    Stores the AOP tables in a worker process so they are sent to each worker once instead of with every AOP
+    :param tables (AOPTables): AOP Wiki tables, see load_tables()
+    """
+    global worker_tables
+    worker_tables = tables
+
+
+def write_aop_worker(AOP_num, outfile, collect_metrics=False, keep_graph=False):
+    """
+    Runs write_aop() in a worker process using the tables stored by init_worker()
+    :return(int, str, list, dict, list, TTLGraph): see write_aop()
+    """
+    return write_aop(AOP_num, worker_tables, outfile, collect_metrics, keep_graph)
+
+
+def write_aops(AOP_nums, tables, output_dir, workers=1, collect_metrics=False, keep_graph=False):
+    """
+    Writes a ttl file for each AOP, in parallel if workers > 1. Results are returned
+        in the order of AOP_nums regardless of the order the workers finish in.
+    :param AOP_nums (list): AOPs to write
+    :param tables (AOPTables): AOP Wiki tables, see load_tables()
+    :param output_dir (str): Directory to write the ttl files to
+    :param workers (int): Number of worker processes
+    :param collect_metrics (bool): Whether to record the wall time and counters of each stage
+    :param keep_graph (bool): Whether to return each AOP's statements for the combined file
+    :return(iterator): (AOP_num, error_c, log entry, relationships, metrics, term pairs, graph) for each AOP,
+        see write_aop()
+    """
+    outfiles = [f"{output_dir}/AOP_{AOP_num}.ttl" for AOP_num in AOP_nums]
+    if workers <= 1:
+        results = (write_aop(AOP_num, tables, outfile, collect_metrics, keep_graph)
+                   for AOP_num, outfile in zip(AOP_nums, outfiles))
+        for AOP_num, result in zip(AOP_nums, results):
+            yield (AOP_num, ) + result
+        return
+
+    chunksize = max(1, len(AOP_nums) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(tables,)) as executor:
+        for AOP_num, result in zip(AOP_nums, executor.map(write_aop_worker, AOP_nums, outfiles,
+                                                                   itertools.repeat(collect_metrics),
+                                                                   itertools.repeat(keep_graph),
+                                                                   chunksize=chunksize)):
+            yield (AOP_num, ) + result
+
+
+def record_review_tables(aop_tables, review_tables):
+    """
+    Passes a stream of single-AOP tables through, recording each AOP's KE and KER rows so its review
+        rows can be built once its term pairs are returned. The caller pops each AOP's rows from
+        review_tables when its result arrives, so only the AOPs in progress are held.
+    :param aop_tables (iterator): AOPTables of each AOP, see stream_tables()
+    :param review_tables (dict): Filled with the (KE rows, KER rows) of each AOP by AOP number
+    :return(iterator): the AOPTables of aop_tables
+    """
+    for tables in aop_tables:
+        AOP_num = next(iter(tables.EC))
+        review_tables[AOP_num] = (tables.KE[AOP_num], tables.KER[AOP_num])
+        yield tables
+
+
+def write_aop_stream_worker(AOP_num, EC, KE, KER, outfile, collect_metrics=False, keep_graph=False):
+    """
+    Runs write_aop() in a worker process on the tables of one AOP, using the AOP info table stored by init_worker().
+        The term caches are cleared afterwards, see clear_term_caches().
+    :return(int, str, list, dict, list, TTLGraph): see write_aop()
+    """
+    result = write_aop(AOP_num, AOPTables(EC, KE, KER, worker_tables.info), outfile, collect_metrics, keep_graph)
+    clear_term_caches()
+    return result
+
+
+def write_aops_streaming(aop_tables, output_dir, workers=1, collect_metrics=False, keep_graph=False):
+    """
+    Writes a ttl file for each AOP from a stream of single-AOP tables, in parallel if workers > 1.
+        At most 2 * workers AOPs are held at a time, and results are returned in the order of the stream.
+        The term caches are cleared after each AOP, so memory use does not grow with the size of the tables.
+    :param aop_tables (iterator): AOPTables of each AOP, see stream_tables()
+    :param output_dir (str): Directory to write the ttl files to
+    :param workers (int): Number of worker processes
+    :param collect_metrics (bool): Whether to record the wall time and counters of each stage
+    :param keep_graph (bool): Whether to return each AOP's statements for the combined file
+    :return(iterator): (AOP_num, error_c, log entry, relationships, metrics, term pairs, graph) for each AOP,
+        see write_aop()
+    """
+    if workers <= 1:
+        for tables in aop_tables:
+            AOP_num = next(iter(tables.EC))
+            result = write_aop(AOP_num, tables, f"{output_dir}/AOP_{AOP_num}.ttl", collect_metrics, keep_graph)
+            clear_term_caches()
+            yield (AOP_num, ) + result
+        return
+
+    pending = collections.deque()
+    executor = None
+    try:
+        for tables in aop_tables:
+            if executor is None:
+                executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                               initargs=(AOPTables(None, None, None, tables.info),))
+            AOP_num = next(iter(tables.EC))
+            pending.append((AOP_num, executor.submit(write_aop_stream_worker, AOP_num, tables.EC, tables.KE,
+                                                     tables.KER, f"{output_dir}/AOP_{AOP_num}.ttl",
+                                                     collect_metrics, keep_graph)))
+            if len(pending) >= 2 * workers:
+                AOP_num, future = pending.popleft()
+                yield (AOP_num, ) + future.result()
+        while pending:
+            AOP_num, future = pending.popleft()
+            yield (AOP_num, ) + future.result()
+    finally:
+        # also stops the workers if the stream fails or the caller stops early
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def hash_tables(AOP_EC_table, AOP_KE_table, AOP_KER_table, AOP_info):
+    """
+    Hashes the EC, KE and KER rows and the title of each AOP, so that AOPs whose input
+        has not changed between two snapshots of the AOP Wiki can be found
+    :param AOP_EC_table(DF): Full EC table from AOP Wiki
+    :param AOP_KE_table(DF): Full KE table from AOP Wiki
+    :param AOP_KER_table(DF): Full KER table from AOP Wiki
+    :param AOP_info(DF): AOP info table indexed by AOP ID
+    :return(dict): hex digest of each AOP's input rows by AOP number
+    """
+    hashes = {}
+    for table in [AOP_EC_table, AOP_KE_table, AOP_KER_table]:
+        row_hashes = pd.util.hash_pandas_object(table, index=False)
+        for AOP_num, rows in row_hashes.groupby(table["AOP"].to_numpy(), sort=False):
+            hashes.setdefault(AOP_num, hashlib.sha1()).update(rows.to_numpy().tobytes())
+    for AOP_num, h in hashes.items():
+        h.update(str(AOP_info["Title"].get(AOP_num, "")).encode())
+    return {int(AOP_num): h.hexdigest() for AOP_num, h in hashes.items()}
+
+
+def read_manifest(output_dir):
+    """
+    Reads the manifest of a previous run
+    :param output_dir (str): Output directory of the previous run
+    :return(dict): manifest entry of each AOP by AOP number, empty if there is no manifest or it
+        was written by a different relationship decision tree or ttl output version
+    """
+    try:
+        with open(f"{output_dir}/manifest.json") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {}
+    if manifest["relationship_tree_version"] != RELATIONSHIP_TREE_VERSION or \
+            manifest["ttl_output_version"] != TTL_OUTPUT_VERSION:
+        return {}
+    return {int(AOP_num): entry for AOP_num, entry in manifest["aops"].items()}
+
+
+class ManifestWriter:
+    """
+    Writes the manifest of the input hashes and results of each AOP to output_dir/manifest.json as
+        the AOPs are written, so the entries are not held in memory until the end of the run. The
+        manifest is written to a temporary file that is renamed into place when the writer is closed.
+    """
+
+    def __init__(self, output_dir):
+        """
+        :param output_dir (str): Output directory of the run
+        """
+        self.path = f"{output_dir}/manifest.json"
+        self.tmpfile = f"{self.path}.{os.getpid()}.tmp"
+        self.f = open(self.tmpfile, "w")
+        self.f.write(f'{{"relationship_tree_version": {RELATIONSHIP_TREE_VERSION}, '
+                     f'"ttl_output_version": {TTL_OUTPUT_VERSION}, "aops": {{')
+        self.AOP_nums = []  # AOPs written so far
+
+    def add_aop(self, AOP_num, entry):
+        """
+        Adds an AOP's entry to the manifest
+        :param AOP_num (int): AOP number
+        :param entry (dict): hash, error_c, log and relationships of the AOP
+        """
+        separator = "," if self.AOP_nums else ""
+        self.f.write(f"{separator}\n{json.dumps(str(AOP_num))}: {json.dumps(entry)}")
+        self.AOP_nums.append(AOP_num)
+
+    def close(self):
+        """
+        Ends the manifest and moves it into place
+        """
+        self.f.write("\n}}\n")
+        self.f.close()
+        os.replace(self.tmpfile, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+            os.remove(self.tmpfile)
+
+
+def link_or_copy(src, dst):
+    """
+    Hardlinks src to dst, copying it instead if it cannot be linked (e.g. across filesystems)
+    :param src (str): Existing file
+    :param dst (str): Path to link or copy to
+    """
+    if os.path.exists(dst):
+        if os.path.samefile(src, dst):
+            return
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def write_aops_incremental(AOP_nums, tables, output_dir, hashes, previous_dir, workers=1, collect_metrics=False,
+                           keep_graph=False):
+    """
+    Writes a ttl file for each AOP whose input rows changed since the run in previous_dir, and
+        links or copies the previous ttl files of the AOPs that did not change
+    :param AOP_nums (list): AOPs to write
+    :param tables (AOPTables): AOP Wiki tables, see load_tables()
+    :param output_dir (str): Directory to write the ttl files to
+    :param hashes (dict): Input hashes of each AOP, from hash_tables()
+    :param previous_dir (str): Output directory of the previous run
+    :param workers (int): Number of worker processes
+    :param collect_metrics (bool): Whether to record the wall time and counters of each stage of the
+        rebuilt AOPs
+    :param keep_graph (bool): Whether to return each AOP's statements for the combined file. The AOPs
+        that did not change are built again in this process to get theirs, but not rewritten.
+    :return(iterator): (AOP_num, error_c, log entry, relationships, metrics, term pairs, graph) for each AOP,
+        see write_aop(). metrics and term pairs are None for the AOPs that were not rebuilt.
+    """
+    previous = read_manifest(previous_dir)
+    unchanged = {AOP_num for AOP_num in AOP_nums if AOP_num in previous and
+                 previous[AOP_num]["hash"] == hashes.get(AOP_num) and
+                 previous[AOP_num]["error_c"] is not None and
+                 os.path.exists(f"{previous_dir}/AOP_{AOP_num}.ttl")}
+    results = write_aops([AOP_num for AOP_num in AOP_nums if AOP_num not in unchanged], tables, output_dir,
+                         workers, collect_metrics, keep_graph)
+    for AOP_num in AOP_nums:
+        if AOP_num in unchanged:
+            link_or_copy(f"{previous_dir}/AOP_{AOP_num}.ttl", f"{output_dir}/AOP_{AOP_num}.ttl")
+            entry = previous[AOP_num]
+            graph = build_aop(AOP_num, tables).graph() if keep_graph else None
+            yield AOP_num, entry["error_c"], entry["log"], entry["relationships"], None, None, graph
+        else:
+            yield next(results)
+
+
+def metrics_records(AOP_num, metrics):
+    """
+    Flattens the metrics of one AOP into one record per stage
+    :param AOP_num (int): AOP number
+    :param metrics (dict): Metrics of each stage by stage name, see record_stage()
+    :return(list of dicts): records with the AOP, stage, wall time and counters of each stage
+    """
+    return [{"AOP": AOP_num, "stage": stage, **values} for stage, values in metrics.items()]
+
+
+def summarize_metrics(records):
+    """
+    Summarizes the metrics of every AOP by stage
+    :param records (list of dicts): Records from metrics_records()
+    :return(DF): number of AOPs, total, mean and maximum wall time, share of the total wall time,
+        and the sum of each counter, by stage
+    """
+    metrics = pd.DataFrame(records)
+    stages = metrics.groupby("stage", sort=False)
+    summary = pd.DataFrame({"AOPs": stages["AOP"].count(),
+                            "total (s)": stages["time"].sum(),
+                            "mean (ms)": stages["time"].mean() * 1000,
+                            "max (ms)": stages["time"].max() * 1000})
+    summary["share"] = (summary["total (s)"] / summary["total (s)"].sum()).map("{:.1%}".format)
+    counters = [column for column in metrics.columns if column not in ("AOP", "stage", "time")]
+    summary[counters] = stages[counters].sum(min_count=1).astype("Int64")
+    return summary
+
+
+# Columns of the curator review table, as in the term_pairs review sheets, with the AOP number first
+review_columns = ["AOP", "action1", "source_1", "id_1", "term_1", "EC1_type", "relationship", "relationship_id",
+                  "action2", "source_2", "id_2", "term_2", "EC2_type", "ke", "KER", "ke_title", "KE term",
+                  "KE term id"]
+
+
+def create_review_table(review_pairs, AOP_KE_table, AOP_KER_table):
+    """
+    Builds the curator review table of many AOPs at once from their term pairs: one row per pair of
+        terms, with the suggested relationships, the KE (or "KE1_KE2" for pairs between two KEs),
+        the KER joining the two KEs and the KE title
+    :param review_pairs (list of tuples): (AOP_num, *TermPair) of each term pair, see create_ttl_dicts()
+    :param AOP_KE_table(DF): Full KE table from AOP Wiki
+    :param AOP_KER_table(DF): Full KER table from AOP Wiki
+    :return(DF): review table with review_columns
+    """
+    pairs = pd.DataFrame.from_records(review_pairs, columns=["AOP", *TermPair._fields])
+    table = pd.DataFrame({"AOP": pairs["AOP"]})
+    for n in ["1", "2"]:
+        table[f"action{n}"] = pairs[f"action{n}"]
+        table[f"source_{n}"] = pairs[f"source{n}"].astype(object)
+        table[f"id_{n}"] = pairs[f"id{n}"]
+        table[f"term_{n}"] = pairs[f"term{n}"]
+        table[f"EC{n}_type"] = pairs[f"ECtype{n}"].str.lower()
+
+    # Label each distinct combination of relationship IDs once
+    relationship_ids = pairs["relationship_ids"]
+    combinations = relationship_ids.drop_duplicates()
+    labels = {ids: "|".join(relationship_labels.get(i, "") for i in ids) for ids in combinations}
+    table["relationship"] = relationship_ids.map(labels)
+    table["relationship_id"] = relationship_ids.map({ids: "|".join(ids) for ids in combinations})
+
+    same_KE = pairs["ke1"] == pairs["ke2"]
+    table["ke"] = pairs["ke1"].astype(str).where(same_KE, pairs["ke1"].astype(str) + "_" + pairs["ke2"].astype(str))
+
+    KERs = AOP_KER_table[["AOP", "Event1", "Event2", "Relationship"]].drop_duplicates(["AOP", "Event1", "Event2"])
+    KERs = KERs.rename(columns={"Event1": "ke1", "Event2": "ke2", "Relationship": "KER"})
+    table["KER"] = pairs[["AOP", "ke1", "ke2"]].merge(KERs, how="left", on=["AOP", "ke1", "ke2"])["KER"].to_numpy()
+    table["KER"] = table["KER"].astype("Int64").where(~same_KE)
+
+    # KE titles as in create_AO_dict(), on the rows of pairs within one KE
+    titles = AOP_KE_table[["AOP", "KE", "Adverse Outcome"]].drop_duplicates(["AOP", "KE"])
+    titles = titles.rename(columns={"KE": "ke1", "Adverse Outcome": "ke_title"})
+    titles["ke_title"] = titles["ke_title"].str.replace(",", ";", regex=False)
+    table["ke_title"] = pairs[["AOP", "ke1"]].merge(titles, how="left", on=["AOP", "ke1"])["ke_title"].to_numpy()
+    table["ke_title"] = table["ke_title"].where(same_KE)
+
+    table["KE term"] = np.nan
+    table["KE term id"] = np.nan
+    return table[review_columns]
+
+
+# Columns of the outfile review sheets with the AOP number first, and the review_columns each is taken from
+outfile_columns = {"AOP": "AOP", "action": "action1", "source_1": "source_1", "id_1": "id_1", "term_1": "term_1",
+                   "source_2": "source_2", "id_2": "id_2", "term_2": "term_2", "ke(s)": "ke",
+                   "adverse_outcome": "ke_title"}
+
+
+def create_outfile_table(review_table):
+    """
+    Projects the curator review table onto the layout of the outfile review sheets (e.g.
+        outfile_09122022_AOP23.csv), with the KE title as the adverse outcome
+    :param review_table (DF): Review table from create_review_table()
+    :return(DF): review table with the outfile_columns
+    """
+    return review_table[list(outfile_columns.values())].set_axis(list(outfile_columns), axis=1)
+
+
+# Number of term pairs whose review rows are built and written at a time
+review_batch_size = 20000
+
+
+def write_review_batch(review_batch, review_writers):
+    """
+    Builds the review table of a batch of AOPs and appends it to each review table file
+    :param review_batch (list of tuples): (AOP_num, term pairs, KE rows, KER rows) of each AOP, see create_ttl_dicts()
+    :param review_writers (list of ReviewTableWriter): Review table files to append to
+    """
+    review_pairs = [(AOP_num, *pair) for AOP_num, term_pairs, _, _ in review_batch for pair in term_pairs]
+    review_table = create_review_table(review_pairs, pd.concat([KE_rows for _, _, KE_rows, _ in review_batch]),
+                                       pd.concat([KER_rows for _, _, _, KER_rows in review_batch]))
+    for review_writer in review_writers:
+        review_writer.add_table(review_table)
+
+
+# Types of the review table columns that are not strings, in either layout. The other columns hold strings.
+review_column_dtypes = {"AOP": "int64", "KER": "Int64", "KE term": "float64", "KE term id": "float64"}
+
+
+class ReviewTableWriter:
+    '''
+    Appends review tables to one file as they are built, as CSV, or as Parquet if the path ends in
+        .parquet, so the review rows of every AOP need not be held at once. The file is written to a
+        temporary file that is renamed to path when the writer is closed.
+    '''
+
+    def __init__(self, path, outfile=False):
+        '''
+        :param path (str): Review table file to write
+        :param outfile (bool): Whether to write the layout of the outfile sheets, see create_outfile_table()
+        '''
+        self.path = path
+        self.outfile = outfile
+        self.tmpfile = f"{path}.{os.getpid()}.tmp"
+        columns = list(outfile_columns) if outfile else review_columns
+        if path.endswith(".parquet"):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            # a fixed schema, so that columns that are empty in some AOPs keep the same type
+            empty = pd.DataFrame({column: pd.Series(dtype=review_column_dtypes.get(column, object))
+                                  for column in columns})
+            self.schema = pa.Schema.from_pandas(empty, preserve_index=False)
+            for i, field in enumerate(self.schema):
+                if pa.types.is_null(field.type):
+                    self.schema = self.schema.set(i, field.with_type(pa.large_string()))
+            self.parquet = pq.ParquetWriter(self.tmpfile, self.schema)
+            self.f = None
+        else:
+            self.parquet = None
+            self.f = open(self.tmpfile, "w", newline="")
+            pd.DataFrame(columns=columns).to_csv(self.f, index=False)
+
+    def add_table(self, review_table):
+        '''
+        Appends the rows of a review table
+        :param review_table (DF): Review table from create_review_table()
+        '''
+        if self.outfile:
+            review_table = create_outfile_table(review_table)
+        if self.parquet is not None:
+            import pyarrow as pa
+            self.parquet.write_table(pa.Table.from_pandas(review_table, schema=self.schema, preserve_index=False))
+        else:
+            review_table.to_csv(self.f, header=False, index=False)
+
+    def close(self):
+        '''
+        Finishes the file and moves it into place
+        '''
+        if self.parquet is not None:
+            self.parquet.close()
+        else:
+            self.f.close()
+        os.replace(self.tmpfile, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            if self.parquet is not None:
+                self.parquet.close()
+            else:
+                self.f.close()
+            os.remove(self.tmpfile)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a ttl file for each AOP in the AOP Wiki tables")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes used to write the AOPs (default: 1)")
+    parser.add_argument("--tables-dir", default="aop_wiki_tables",
+                        help="Directory containing the AOP Wiki tables (default: aop_wiki_tables)")
+    parser.add_argument("--datestamp", default="082423",
+                        help="Name of the directory in output/ to write the ttl files to")
+    parser.add_argument("--incremental", metavar="PREVIOUS_OUTPUT_DIR",
+                        help="Only rebuild the AOPs whose input changed since the run in PREVIOUS_OUTPUT_DIR, "
+                             "and link or copy the other AOPs' ttl files from it")
+    parser.add_argument("--combined", metavar="PATH",
+                        help="Also write every AOP into one combined TriG file with a named graph per AOP, gzip "
+                             "compressed if PATH ends in .gz")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Parse the AOP Wiki tables without loading or writing the Parquet snapshot")
+    parser.add_argument("--cache-dir", default=TABLE_CACHE_DIR,
+                        help=f"Directory holding the Parquet snapshots of the tables (default: {TABLE_CACHE_DIR})")
+    parser.add_argument("--stream", action="store_true",
+                        help="Read the EC, KE and KER tables in chunks and build one AOP at a time, keeping memory "
+                             "use bounded. The tables must be sorted by AOP.")
+    parser.add_argument("--chunksize", type=int, default=100000,
+                        help="Number of rows read from each table at a time with --stream (default: 100000)")
+    parser.add_argument("--validate", metavar="REPORT",
+                        help="Validate each ttl file in a separate pool of worker processes while the AOPs are "
+                             "written, and write a JSON report of the results to REPORT")
+    parser.add_argument("--review", metavar="PATH",
+                        help="Also write a curator review table of the term pairs and suggested relationships of "
+                             "every AOP to PATH, in the layout of the term_pairs sheets (CSV, or Parquet if PATH "
+                             "ends in .parquet)")
+    parser.add_argument("--review-outfile", metavar="PATH",
+                        help="Also write the review table of every AOP to PATH in the layout of the outfile sheets "
+                             "(CSV, or Parquet if PATH ends in .parquet)")
+    parser.add_argument("--metrics", metavar="PATH",
+                        help="Record the wall time and counters of each stage of each AOP to a JSON lines file "
+                             "and print a summary by stage at the end of the run")
+    args = parser.parse_args()
+    if args.stream and args.incremental:
+        parser.error("--stream cannot be combined with --incremental")
+    review = args.review or args.review_outfile
+    if review and args.incremental:
+        parser.error("--review and --review-outfile cannot be combined with --incremental, the AOPs that are not "
+                     "rebuilt have no term pairs")
+
+    datestamp = args.datestamp
+    if args.stream:
+        hashes = {}  # filled in as the AOPs are streamed
+        aop_tables = stream_tables(args.tables_dir, args.chunksize, hashes)
+        if review:
+            review_tables = {}  # KE and KER rows of the streamed AOPs in progress
+            aop_tables = record_review_tables(aop_tables, review_tables)
+        AOP_info = pd.read_csv(f"{args.tables_dir}/AOP_info.csv").set_index("ID")
+    else:
+        AOP_EC_table, AOP_KE_table, AOP_KER_table, AOP_info = import_tables(args.tables_dir, not args.no_cache,
+                                                                            args.cache_dir)
+        hashes = hash_tables(AOP_EC_table, AOP_KE_table, AOP_KER_table, AOP_info)
+        precompute_term_features(AOP_EC_table)
+        # Group the tables by AOP once instead of filtering the full tables for every AOP
+        tables = AOPTables(*partition_tables(AOP_EC_table, AOP_KE_table, AOP_KER_table), AOP_info)
+
+        AOP_nums = list_aops(tables)
+    # AOP_nums = [100, 101, 102, 103, 104, 105]
+    # AOP_nums = [200]
+    # AOP_nums = [23]
+    # AOP_nums = [102]
+    # AOP_nums = [429, 411, 412]
+    c_completed = []
+    c_missing = []
+    output_dir = f"output/{datestamp}"
+    log = f"{output_dir}/log.txt"
+    os.makedirs(output_dir, exist_ok=True)
+
+    all_relationships = set() # relationships from all AOPs
+    metrics_log = []  # metrics of each stage of each AOP, when --metrics is given
+    review_batch = []  # (AOP_num, term pairs, KE rows, KER rows) of the AOPs not yet in the review tables
+    review_batch_pairs = 0  # number of term pairs in review_batch
+
+    collect_metrics = args.metrics is not None
+    keep_graph = args.combined is not None
+    if args.stream:
+        results = write_aops_streaming(aop_tables, output_dir, args.workers, collect_metrics, keep_graph)
+    elif args.incremental:
+        results = write_aops_incremental(AOP_nums, tables, output_dir, hashes, args.incremental, args.workers,
+                                         collect_metrics, keep_graph)
     else:
-        c_completed.append(AOP_num)
+        results = write_aops(AOP_nums, tables, output_dir, args.workers, collect_metrics, keep_graph)
+
+    # Write a ttl file for each AOP in AOP_nums. Keep a list of successful and failed AOPs, and
+    #   log the error message when an AOP fails. Log entries are written in AOP order.
+    combined = CombinedTTLWriter(args.combined) if args.combined else contextlib.nullcontext()
+    # Index of the relationship edges of every AOP. Incremental runs start from the previous run's index
+    #   and replace the edges of the rebuilt AOPs.
+    edges_file = f"{output_dir}/edges.sqlite"
+    edges_tmpfile = f"{edges_file}.{os.getpid()}.tmp"
+    if args.incremental and os.path.exists(f"{args.incremental}/edges.sqlite"):
+        shutil.copy2(f"{args.incremental}/edges.sqlite", edges_tmpfile)
+    elif args.incremental:
+        print(f"{args.incremental}/edges.sqlite not found, only the rebuilt AOPs are indexed")
+    edges = edge_index.open_edge_index(edges_tmpfile)
+    # Files are validated in their own pool as they are written, overlapping validation with writing
+    validator = ProcessPoolExecutor(max_workers=max(1, args.workers)) if args.validate else None
+    validations = []
+    with open(log, "w+") as logf, combined, ManifestWriter(output_dir) as manifest, \
+            contextlib.ExitStack() as review_files:
+        review_writers = [review_files.enter_context(ReviewTableWriter(path, outfile))
+                          for path, outfile in [(args.review, False), (args.review_outfile, True)] if path]
+        for AOP_num, error_c, aop_summary_txt, aop_relationships, aop_metrics, term_pairs, graph in results:
+            logf.write(aop_summary_txt)
+            if review:
+                # review rows are built in batches from the KE and KER rows each AOP was built from
+                if args.stream:
+                    AOP_KE_rows, AOP_KER_rows = review_tables.pop(AOP_num)
+                else:
+                    AOP_KE_rows, AOP_KER_rows = tables.KE[AOP_num], tables.KER[AOP_num]
+                if term_pairs:
+                    review_batch.append((AOP_num, term_pairs, AOP_KE_rows, AOP_KER_rows))
+                    review_batch_pairs += len(term_pairs)
+                if review_batch_pairs >= review_batch_size:
+                    write_review_batch(review_batch, review_writers)
+                    review_batch, review_batch_pairs = [], 0
+            if term_pairs is not None:
+                edge_index.replace_aop_edges(edges, AOP_num, term_pairs)
+            if aop_metrics is not None:
+                metrics_log += metrics_records(AOP_num, aop_metrics)
+            all_relationships.update(aop_relationships)
+            # hashes are dropped once used, so a streamed run does not hold one per AOP
+            manifest.add_aop(AOP_num, {"hash": hashes.pop(AOP_num, None), "error_c": error_c, "log": aop_summary_txt,
+                                       "relationships": aop_relationships})
+            if error_c is None:
+                continue
+            if args.combined:
+                combined.add_aop(graph)
+            if validator is not None:
+                validations.append(validator.submit(validate_ttl.validate_ttl_file,
+                                                    f"{output_dir}/AOP_{AOP_num}.ttl"))
+            print(AOP_num, get_title(AOP_num, AOP_info))
+            if error_c > 0:
+                c_missing.append(AOP_num)
+            else:
+                c_completed.append(AOP_num)
+
+        if review_batch:
+            write_review_batch(review_batch, review_writers)
+
+        logf.write(f"\nResults:{len(c_completed)} complete, {len(c_missing)} have missing components")
+    print(f"Results:{len(c_completed)} are complete, {len(c_missing)} have missing elements")
+    edge_index.keep_aops(edges, manifest.AOP_nums)
+    edges.commit()
+    edges.close()
+    os.replace(edges_tmpfile, edges_file)
+
+    if validator is not None:
+        n_invalid = validate_ttl.write_report(args.validate, [validation.result() for validation in validations])
+        validator.shutdown()
+        print(f"Validation: {n_invalid} of {len(validations)} ttl files are invalid, see {args.validate}")
 
-with open(log, 'a') as logf:
-    logf.write(f"\nResults:{len(c_completed)} complete, {len(c_missing)} have missing components")
-print(f"Results:{len(c_completed)} are complete, {len(c_missing)} have missing elements")
+    if collect_metrics:
+        with open(args.metrics, "w") as f:
+            for record in metrics_log:
+                f.write(json.dumps(record) + "\n")
+        if metrics_log:
+            print(summarize_metrics(metrics_log).to_string(na_rep=""))
 
-all_relationships = list(set(all_relationships))
+    all_relationships = list(all_relationships)
 
-# c_error: [1, 12, 13, 16, 17, 36, 37, 39, 40, 57, 58, 60, 61, 72, 78, 82, 86, 90, 97, 151, 186, 190, 191, 195, 202, 203, 204, 206, 209, 213, 214, 215, 216, 218, 219, 220, 230, 233, 235, 238, 241, 242, 245, 256, 257, 258, 264, 265, 266, 267, 268, 272, 273, 274, 275, 276, 277, 278, 280, 285, 286, 289, 290, 291, 292, 293, 294, 296, 297, 299, 300, 302, 303, 305, 306, 307, 309, 310, 311, 312, 318, 319, 320, 322, 323, 324, 325, 326, 327, 328, 329, 330, 331, 335, 336, 337, 338, 340, 341, 343, 344, 345, 347, 348, 349, 358, 359, 361, 365, 366, 367, 374, 377, 379, 382, 383, 384, 385, 386, 387, 388, 389, 392, 394, 396, 398, 399, 406, 409, 410, 411, 412, 413, 422, 424, 425, 428, 429, 430]
+    # c_error: [1, 12, 13, 16, 17, 36, 37, 39, 40, 57, 58, 60, 61, 72, 78, 82, 86, 90, 97, 151, 186, 190, 191, 195, 202, 203, 204, 206, 209, 213, 214, 215, 216, 218, 219, 220, 230, 233, 235, 238, 241, 242, 245, 256, 257, 258, 264, 265, 266, 267, 268, 272, 273, 274, 275, 276, 277, 278, 280, 285, 286, 289, 290, 291, 292, 293, 294, 296, 297, 299, 300, 302, 303, 305, 306, 307, 309, 310, 311, 312, 318, 319, 320, 322, 323, 324, 325, 326, 327, 328, 329, 330, 331, 335, 336, 337, 338, 340, 341, 343, 344, 345, 347, 348, 349, 358, 359, 361, 365, 366, 367, 374, 377, 379, 382, 383, 384, 385, 386, 387, 388, 389, 392, 394, 396, 398, 399, 406, 409, 410, 411, 412, 413, 422, 424, 425, 428, 429, 430]